@@ -0,0 +1,110 @@
+"""
+Maintenance commands for the KushuKushu ERP backend
+
+Usage (from the backend directory):
+    python manage.py rebuild-ledger
+    python manage.py migrate-timestamps
+    python manage.py indexes [--apply]
+    python manage.py rebuild-customers
+    python manage.py loan-aging
+    python manage.py import <collection> <file.ndjson>
+"""
+import argparse
+import asyncio
+import json
+
+import server
+
+
+async def rebuild_ledger(args):
+    ledger = await server.rebuild_finance_ledger()
+    print(json.dumps(ledger, indent=2, default=str))
+
+
+async def migrate_timestamps(args):
+    migrated = await server.migrate_timestamps(batch_size=args.batch_size)
+    for collection_name, count in migrated.items():
+        print(f"  {collection_name}: {count} document(s) converted")
+    print(f"\nTotal: {sum(migrated.values())} document(s) converted")
+
+
+async def indexes(args):
+    if args.apply:
+        failed = await server.ensure_indexes()
+        for collection_name, names in failed.items():
+            print(f"  [FAILED] {collection_name}: {', '.join(names)}")
+
+    report = await server.index_report()
+    for collection_name, entry in report.items():
+        print(f"\n{collection_name}")
+        print(f"  missing:      {', '.join(entry['missing']) or '-'}")
+        print(f"  unregistered: {', '.join(entry['unregistered']) or '-'}")
+        print(f"  unused:       {', '.join(entry['unused']) or '-'}")
+
+
+async def rebuild_customers(args):
+    count = await server.rebuild_customers()
+    print(f"  {count} customer(s) in directory")
+
+
+async def loan_aging(args):
+    result = await server.run_loan_aging()
+    print(f"  {result['loans']} active loan(s), {result['overdue']} overdue, {result['re_rated']} re-rated")
+
+
+async def read_chunks(path, size=64 * 1024):
+    with open(path, "rb") as f:
+        while chunk := f.read(size):
+            yield chunk
+
+
+async def import_ndjson(args):
+    result = await server.import_ndjson(args.collection, server.iter_lines(read_chunks(args.file)))
+    for error in result["errors"]:
+        print(f"  line {error['line']}: {error['error']}")
+    print(f"\n{result['inserted']} row(s) inserted, {result['failed']} rejected")
+
+
+COMMANDS = {
+    "rebuild-ledger": rebuild_ledger,
+    "migrate-timestamps": migrate_timestamps,
+    "indexes": indexes,
+    "rebuild-customers": rebuild_customers,
+    "loan-aging": loan_aging,
+    "import": import_ndjson,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KushuKushu ERP maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("rebuild-ledger", help="Recompute finance ledger totals from scratch")
+
+    migrate = subparsers.add_parser("migrate-timestamps", help="Convert string timestamps to native BSON dates")
+    migrate.add_argument("--batch-size", type=int, default=500)
+
+    index_parser = subparsers.add_parser("indexes", help="Report missing, unregistered and unused indexes")
+    index_parser.add_argument("--apply", action="store_true", help="Create missing indexes before reporting")
+
+    subparsers.add_parser("rebuild-customers", help="Recompute the customer directory from loans and sales")
+    subparsers.add_parser("loan-aging", help="Recompute loan aging buckets, overdue flags and ratings")
+
+    import_parser = subparsers.add_parser("import", help="Bulk-load an NDJSON file into a core collection")
+    import_parser.add_argument("collection", choices=sorted(server.IMPORT_SPECS))
+    import_parser.add_argument("file")
+
+    args = parser.parse_args()
+
+    print("\n" + "=" * 70)
+    print(f"{args.command.upper()} ({server.db.name})")
+    print("=" * 70)
+
+    try:
+        asyncio.run(COMMANDS[args.command](args))
+    finally:
+        server.client.close()
+
+
+if __name__ == "__main__":
+    main()
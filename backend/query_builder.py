@@ -0,0 +1,92 @@
+"""
+Small fluent builder for MongoDB aggregation pipelines
+
+Keeps dashboard/report queries readable and lets the heavy lifting happen
+inside MongoDB so only the final numbers are sent back to the API.
+
+Example:
+    totals = await (
+        Pipeline()
+        .match({"status": "active"})
+        .group(None, total=sum_of("balance"), count=count())
+        .first(db.loans)
+    )
+"""
+from typing import Any, Dict, List, Optional
+
+
+def field(name: str) -> str:
+    """Reference a document field inside an expression"""
+    return name if name.startswith("$") else f"${name}"
+
+
+def sum_of(expr: Any) -> Dict[str, Any]:
+    """$sum accumulator over a field name or expression"""
+    return {"$sum": field(expr) if isinstance(expr, str) else expr}
+
+
+def count() -> Dict[str, Any]:
+    """Count accumulator"""
+    return {"$sum": 1}
+
+
+def multiply(*exprs: Any) -> Dict[str, Any]:
+    """$multiply over field names and/or expressions, treating missing fields as 0"""
+    return {"$multiply": [
+        {"$ifNull": [field(e), 0]} if isinstance(e, str) else e
+        for e in exprs
+    ]}
+
+
+def cond(condition: Dict[str, Any], then: Any, otherwise: Any = 0) -> Dict[str, Any]:
+    """$cond expression"""
+    return {"$cond": [condition, then, otherwise]}
+
+
+class Pipeline:
+    """Fluent aggregation pipeline builder"""
+
+    def __init__(self, stages: Optional[List[Dict[str, Any]]] = None):
+        self.stages: List[Dict[str, Any]] = list(stages or [])
+
+    def add(self, stage: Dict[str, Any]) -> "Pipeline":
+        self.stages.append(stage)
+        return self
+
+    def match(self, query: Dict[str, Any]) -> "Pipeline":
+        if query:
+            self.add({"$match": query})
+        return self
+
+    def group(self, key: Any, **accumulators: Dict[str, Any]) -> "Pipeline":
+        if isinstance(key, str):
+            key = field(key)
+        elif isinstance(key, dict):
+            key = {k: field(v) if isinstance(v, str) else v for k, v in key.items()}
+        return self.add({"$group": {"_id": key, **accumulators}})
+
+    def project(self, **fields: Any) -> "Pipeline":
+        return self.add({"$project": fields})
+
+    def sort(self, **fields: int) -> "Pipeline":
+        return self.add({"$sort": fields})
+
+    def union_with(self, collection_name: str, pipeline: Optional["Pipeline"] = None) -> "Pipeline":
+        stage: Dict[str, Any] = {"coll": collection_name}
+        if pipeline is not None:
+            stage["pipeline"] = pipeline.build()
+        return self.add({"$unionWith": stage})
+
+    def build(self) -> List[Dict[str, Any]]:
+        return list(self.stages)
+
+    async def run(self, collection, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Execute against a Motor collection and return the result documents"""
+        return await collection.aggregate(self.build()).to_list(length)
+
+    async def first(self, collection, default: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Execute and return the first result document (or `default`)"""
+        results = await collection.aggregate(self.build()).to_list(1)
+        if results:
+            return results[0]
+        return dict(default or {})
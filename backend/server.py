@@ -1,37 +1,44 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.base import BaseHTTPMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, CursorType, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional, Dict, Any
+from collections import deque
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 import os
+import asyncio
+import base64
+import csv
+import hashlib
+import io
+import json
 import logging
+import re
 from pathlib import Path
 import uuid
 
+from query_builder import Pipeline, sum_of, count, multiply, cond
+
 # Load environment
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so stored dates come back as UTC-aware datetimes and serialize with an offset
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ.get('DB_NAME', 'kushukushu_erp')]
 
 # Create app
 app = FastAPI(title="KushuKushu ERP API", version="2.0.0")
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # API Router
 api_router = APIRouter(prefix="/api")
 
@@ -62,13 +69,13 @@ class RequisitionStatus(str, Enum):
     REJECTED = "rejected"
 
 class StockRequestStatus(str, Enum):
-    PENDING = "pending"
-    MANAGER_APPROVED = "manager_approved"
-    ADMIN_APPROVED = "admin_approved"
+    PENDING_ADMIN_APPROVAL = "pending_admin_approval"
+    PENDING_MANAGER_APPROVAL = "pending_manager_approval"
+    PENDING_FULFILLMENT = "pending_fulfillment"
     PENDING_GATE_APPROVAL = "pending_gate_approval"
     READY_FOR_PICKUP = "ready_for_pickup"
     IN_TRANSIT = "in_transit"
-    DELIVERED = "delivered"
+    CONFIRMED = "confirmed"
     CANCELLED = "cancelled"
 
 # ==================== PYDANTIC MODELS ====================
@@ -169,7 +176,7 @@ class StockRequest(BaseModel):
     requested_by: str
     requested_by_id: str
     requested_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    status: str = "pending"
+    status: str = StockRequestStatus.PENDING_ADMIN_APPROVAL.value
     approved_by_manager_at: Optional[datetime] = None
     approved_by_admin_at: Optional[datetime] = None
     # Batch processing
@@ -207,20 +214,115 @@ class BranchStats(BaseModel):
     active_staff: int
 
 class FinancialControls(BaseModel):
-    model_config = ConfigDict(extra="ignore")
+    # The settings screen stores its own keys alongside these; keep them
+    model_config = ConfigDict(extra="allow")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     finance_daily_limit: float = 500000
     finance_transaction_limit: float = 100000
+    admin_purchase_approval_threshold: float = 50000
+    default_customer_credit_limit: float = 100000
     manager_purchase_limit: float = 50000
     auto_approve_threshold: float = 10000
     require_owner_approval_above: float = 1000000
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_by: str = "system"
+    version: int = 0  # bumped on every update so other workers can notice
 
 # ==================== HELPER FUNCTIONS ====================
 
+def utc_now() -> datetime:
+    """Current UTC time. Timestamps are stored as native BSON dates, never strings."""
+    return datetime.now(timezone.utc)
+
+def today_start_utc() -> datetime:
+    """Midnight UTC of the current day"""
+    return utc_now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+def parse_timestamp(value: Any) -> Optional[datetime]:
+    """Convert a stored or client-supplied timestamp to a UTC-aware datetime
+
+    Accepts datetimes (naive values are assumed to be UTC) and ISO-8601
+    strings, including a trailing 'Z'. Returns None if it cannot be parsed.
+    """
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+async def attach_related(
+    docs: List[Dict[str, Any]],
+    local_field: str,
+    collection,
+    as_field: str,
+    foreign_field: str = "id",
+    projection: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
+    """Attach related documents to `docs` with a single $in query
+
+    For each doc, the document in `collection` whose `foreign_field` equals
+    doc[local_field] is stored under doc[as_field] (left untouched if there
+    is no match). Replaces one find_one per row.
+    """
+    keys = list({doc.get(local_field) for doc in docs if doc.get(local_field) is not None})
+    if not keys:
+        return docs
+    
+    related = await collection.find(
+        {foreign_field: {"$in": keys}},
+        projection or {"_id": 0}
+    ).to_list(None)
+    by_key = {item.get(foreign_field): item for item in related}
+    
+    for doc in docs:
+        match = by_key.get(doc.get(local_field))
+        if match is not None:
+            doc[as_field] = match
+    return docs
+
+async def guarded_update(
+    collection,
+    doc_id: str,
+    guard: Dict[str, Any],
+    update: Dict[str, Any],
+    label: str
+) -> Dict[str, Any]:
+    """Apply `update` only while the document still matches `guard`
+
+    The guard (typically the expected current status) is part of the filter,
+    so the check and the write are a single atomic find_one_and_update and the
+    updated document comes back without a second read. When nothing matches,
+    a diagnostic read tells a missing document (404) from one that is no
+    longer in the expected state (409).
+    """
+    updated = await collection.find_one_and_update(
+        {"id": doc_id, **guard},
+        update,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated:
+        return updated
+
+    current = await collection.find_one({"id": doc_id}, {"_id": 0, "status": 1})
+    if not current:
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    raise HTTPException(
+        status_code=409,
+        detail=f"{label} cannot be updated from its current status: {current.get('status')}"
+    )
+
 async def log_activity(role: str, action: str, description: str, branch: Optional[str] = None, user_name: Optional[str] = None):
-    """Log activity to database"""
+    """Log activity to database
+
+    Entries are handed to the write-behind buffer and flushed in batches, so
+    audit logging stays off the request's critical path. Falls back to a
+    direct insert when the buffer is not running (e.g. maintenance scripts).
+    """
     activity = ActivityLog(
         role=role,
         action=action,
@@ -228,7 +330,877 @@ async def log_activity(role: str, action: str, description: str, branch: Optiona
         branch=branch,
         user_name=user_name
     )
-    await db.activity_logs.insert_one(activity.model_dump())
+    if not activity_log_buffer.enqueue(activity.model_dump()):
+        await write_activity_logs([activity.model_dump()])
+
+# ==================== ACTIVITY LOG BUFFER ====================
+
+_STOP = object()
+
+async def write_activity_logs(entries: List[Dict[str, Any]]):
+    """Persist entries to the full-history archive and the hot feed collection"""
+    await db.activity_logs_archive.insert_many(entries, ordered=False)
+    await db.activity_logs.insert_many(entries, ordered=False)
+
+class ActivityLogBuffer:
+    """In-process write-behind queue for activity log entries
+
+    A background task flushes queued entries with insert_many once
+    `batch_size` entries are waiting or `flush_interval` seconds have passed
+    since the first one arrived. When the queue is full new entries are
+    dropped and counted rather than blocking the request.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: Optional[asyncio.Queue] = None
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_flush_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._stopping
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, entry: Dict[str, Any]) -> bool:
+        """Queue an entry; returns False if the buffer is not running"""
+        if not self.running:
+            return False
+        try:
+            self.queue.put_nowait(entry)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+        return True
+
+    async def stop(self):
+        """Flush everything still queued and stop the background task"""
+        if self._task is None:
+            return
+        self._stopping = True
+        await self.queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self.queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            stop = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry is _STOP:
+                    stop = True
+                    break
+                batch.append(entry)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        try:
+            await write_activity_logs(batch)
+            self.flushed += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception(f"Failed to flush {len(batch)} activity log entries")
+        self.last_flush_at = utc_now()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_queue_size": self.max_size,
+            "batch_size": self.batch_size,
+            "flush_interval_seconds": self.flush_interval,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "last_flush_at": self.last_flush_at
+        }
+
+activity_log_buffer = ActivityLogBuffer(
+    max_size=int(os.environ.get('ACTIVITY_LOG_QUEUE_SIZE', 10000)),
+    batch_size=int(os.environ.get('ACTIVITY_LOG_BATCH_SIZE', 100)),
+    flush_interval=float(os.environ.get('ACTIVITY_LOG_FLUSH_INTERVAL', 1.0))
+)
+
+# ==================== ACTIVITY LOG STORAGE ====================
+
+# `activity_logs` only holds the hot window served by the live feed; every
+# entry is also written to `activity_logs_archive`, which keeps full history.
+# "capped": activity_logs is a capped collection read in natural order and
+#           streamed to the owner dashboard with a tailable cursor.
+# "ttl":    activity_logs is a regular collection whose entries expire after
+#           ACTIVITY_FEED_TTL_DAYS; the stream falls back to polling.
+ACTIVITY_LOG_STORAGE = os.environ.get('ACTIVITY_LOG_STORAGE', 'capped')
+ACTIVITY_FEED_MAX_BYTES = int(os.environ.get('ACTIVITY_FEED_MAX_BYTES', 16 * 1024 * 1024))
+ACTIVITY_FEED_MAX_DOCS = int(os.environ.get('ACTIVITY_FEED_MAX_DOCS', 10000))
+ACTIVITY_FEED_TTL_DAYS = int(os.environ.get('ACTIVITY_FEED_TTL_DAYS', 30))
+ACTIVITY_STREAM_KEEPALIVE_SECONDS = 15
+# Entries reach the feed up to one buffer flush after they are stamped (and
+# workers' clocks differ a little), so the stream looks back this far
+ACTIVITY_STREAM_LOOKBACK = timedelta(seconds=activity_log_buffer.flush_interval + 5)
+
+async def ensure_activity_log_storage():
+    """Set up the hot activity feed collection for the configured storage mode
+
+    Existing entries are merged into the archive before the hot collection
+    is converted, so no history is lost. Every worker runs this at startup,
+    so each step tolerates another worker having just done it: a lost race
+    is detected by re-reading the collection options.
+    """
+    options = await _activity_log_options()
+    
+    if ACTIVITY_LOG_STORAGE == "capped":
+        if options is None:
+            try:
+                await db.create_collection(
+                    "activity_logs", capped=True, size=ACTIVITY_FEED_MAX_BYTES, max=ACTIVITY_FEED_MAX_DOCS
+                )
+                return
+            except CollectionInvalid:
+                options = await _activity_log_options() or {}
+        if not options.get("capped"):
+            logger.info("Archiving activity logs and converting activity_logs to a capped collection...")
+            await _archive_hot_activity_logs()
+            try:
+                await db.command("convertToCapped", "activity_logs", size=ACTIVITY_FEED_MAX_BYTES)
+            except OperationFailure:
+                if not (await _activity_log_options() or {}).get("capped"):
+                    raise
+            options = await _activity_log_options() or {}
+        if options.get("max") != ACTIVITY_FEED_MAX_DOCS:
+            # convertToCapped only takes a size; apply the document cap too
+            try:
+                await db.command("collMod", "activity_logs", cappedMax=ACTIVITY_FEED_MAX_DOCS)
+            except OperationFailure as e:
+                logger.warning(f"Could not set activity_logs max documents (needs MongoDB 6.0+): {e}")
+    elif ACTIVITY_LOG_STORAGE == "ttl":
+        if options and options.get("capped"):
+            logger.info("Archiving activity logs and replacing capped activity_logs with a TTL collection...")
+            await _archive_hot_activity_logs()
+            await db.activity_logs.drop()
+        await db.activity_logs.create_indexes([IndexModel(
+            [("timestamp", ASCENDING)],
+            name="timestamp_ttl",
+            expireAfterSeconds=ACTIVITY_FEED_TTL_DAYS * 24 * 3600
+        )])
+    else:
+        raise ValueError(f"Unknown ACTIVITY_LOG_STORAGE mode: {ACTIVITY_LOG_STORAGE}")
+
+async def _activity_log_options() -> Optional[Dict[str, Any]]:
+    """Options of the hot activity collection, or None if it does not exist"""
+    if "activity_logs" not in await db.list_collection_names():
+        return None
+    return await db.activity_logs.options()
+
+async def _archive_hot_activity_logs():
+    """Copy every hot activity log entry into the archive (skipping ones already there)"""
+    await db.activity_logs.aggregate([
+        {"$merge": {"into": "activity_logs_archive", "on": "_id", "whenMatched": "keepExisting"}}
+    ]).to_list(None)
+
+async def recent_activity(limit: int) -> List[Dict[str, Any]]:
+    """Most recent activity entries from the hot feed collection"""
+    if ACTIVITY_LOG_STORAGE == "capped":
+        # Capped collections keep insertion order, so no sort is needed
+        cursor = db.activity_logs.find({}, {"_id": 0}).sort("$natural", -1)
+    else:
+        cursor = db.activity_logs.find({}, {"_id": 0}).sort("timestamp", -1)
+    return await cursor.limit(limit).to_list(limit)
+
+def format_activity_event(entry: Dict[str, Any]) -> str:
+    """Render an activity log entry as a Server-Sent Event"""
+    return f"id: {entry.get('id')}\nevent: activity\ndata: {json.dumps(jsonable_encoder(entry))}\n\n"
+
+async def stream_activity(request: Request):
+    """Yield new activity entries as Server-Sent Events until the client disconnects
+
+    Each (re)query starts ACTIVITY_STREAM_LOOKBACK before the newest entry
+    sent, so entries flushed late by another worker's buffer are still
+    picked up; `seen_ids` keeps them from being sent twice.
+    """
+    last_seen = utc_now()
+    seen_ids: deque = deque(maxlen=1000)
+    cursor = None
+    
+    while not await request.is_disconnected():
+        if ACTIVITY_LOG_STORAGE == "capped":
+            if cursor is None or not cursor.alive:
+                if cursor is not None:
+                    # Tailable cursors die on an empty collection; back off before reopening
+                    await asyncio.sleep(1)
+                cursor = db.activity_logs.find(
+                    {"timestamp": {"$gte": last_seen - ACTIVITY_STREAM_LOOKBACK}, "id": {"$nin": list(seen_ids)}},
+                    {"_id": 0},
+                    cursor_type=CursorType.TAILABLE_AWAIT
+                ).max_await_time_ms(ACTIVITY_STREAM_KEEPALIVE_SECONDS * 1000)
+            entries = []
+            async for entry in cursor:
+                entries.append(entry)
+                if len(entries) >= 100:
+                    break
+        else:
+            entries = await db.activity_logs.find(
+                {"timestamp": {"$gte": last_seen - ACTIVITY_STREAM_LOOKBACK}, "id": {"$nin": list(seen_ids)}},
+                {"_id": 0}
+            ).sort("timestamp", 1).limit(100).to_list(100)
+            if not entries:
+                await asyncio.sleep(2)
+        
+        sent = False
+        for entry in entries:
+            if entry.get("id") in seen_ids:
+                continue
+            seen_ids.append(entry.get("id"))
+            if isinstance(entry.get("timestamp"), datetime):
+                last_seen = max(last_seen, parse_timestamp(entry["timestamp"]))
+            sent = True
+            yield format_activity_event(entry)
+        if not sent:
+            yield ": keep-alive\n\n"
+
+# ==================== FINANCE LEDGER ====================
+
+# Single running-totals document kept in sync by the write paths with $inc,
+# so /finance/summary never has to scan history.
+FINANCE_LEDGER_ID = "global"
+
+LEDGER_FIELDS = [
+    "total_income",
+    "sales_count",
+    "accounts_receivable",
+    "active_loan_count",
+    "pending_payables",
+    "pending_payables_count",
+    "total_paid_out",
+    "payment_count",
+]
+
+async def update_finance_ledger(**deltas: float):
+    """Atomically apply deltas to the finance ledger totals"""
+    deltas = {field: value for field, value in deltas.items() if value}
+    if not deltas:
+        return
+    await db.finance_ledger.update_one(
+        {"id": FINANCE_LEDGER_ID},
+        {
+            "$inc": deltas,
+            "$set": {"last_updated": utc_now()}
+        },
+        upsert=True
+    )
+
+async def _sum_collection(collection, match: Dict[str, Any], field_name: str) -> Dict[str, float]:
+    """Return {"total": sum(field_name), "count": n} for documents matching `match`"""
+    return await (
+        Pipeline()
+        .match(match)
+        .group(None, total=sum_of(field_name), count=count())
+        .first(collection, {"total": 0, "count": 0})
+    )
+
+async def rebuild_finance_ledger() -> Dict[str, Any]:
+    """Recompute the finance ledger from the source collections"""
+    sales = await _sum_collection(db.sales_transactions, {}, "total_amount")
+    loans = await _sum_collection(db.loans, {"status": "active"}, "balance")
+    payables = await _sum_collection(
+        db.purchase_requisitions,
+        {"status": {"$in": ["admin_approved", "owner_approved"]}},
+        "estimated_cost"
+    )
+    payments = await _sum_collection(db.payments, {"status": "completed"}, "amount")
+
+    ledger = {
+        "id": FINANCE_LEDGER_ID,
+        "total_income": sales["total"],
+        "sales_count": sales["count"],
+        "accounts_receivable": loans["total"],
+        "active_loan_count": loans["count"],
+        "pending_payables": payables["total"],
+        "pending_payables_count": payables["count"],
+        "total_paid_out": payments["total"],
+        "payment_count": payments["count"],
+        "last_updated": utc_now(),
+        "rebuilt_at": utc_now()
+    }
+
+    await db.finance_ledger.replace_one({"id": FINANCE_LEDGER_ID}, ledger, upsert=True)
+    logger.info("Finance ledger rebuilt")
+    return ledger
+
+async def get_finance_ledger() -> Dict[str, Any]:
+    """Read the finance ledger, building it on first use"""
+    ledger = await db.finance_ledger.find_one({"id": FINANCE_LEDGER_ID}, {"_id": 0})
+    if not ledger:
+        ledger = await rebuild_finance_ledger()
+    return ledger
+
+# ==================== FINANCIAL CONTROLS ====================
+
+FINANCIAL_CONTROLS_POLL_SECONDS = float(os.environ.get('FINANCIAL_CONTROLS_POLL_SECONDS', 30))
+
+class FinancialControlsCache:
+    """In-memory snapshot of the single financial_controls document
+
+    Hot paths read the cached, typed snapshot instead of querying Mongo.
+    Local writes go through update() and refresh the snapshot directly;
+    writes made by other workers are picked up by a background task that
+    polls the document's `version` every `poll_interval` seconds (one small
+    read per interval; unlike a change stream it also works on a standalone
+    mongod).
+    """
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self._controls: Optional[FinancialControls] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self) -> FinancialControls:
+        if self._controls is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._controls is None:
+                    self._controls = await self._load()
+        return self._controls
+
+    async def update(self, changes: Dict[str, Any]) -> FinancialControls:
+        """Apply changes, bump the version and refresh the snapshot"""
+        changes = {k: v for k, v in changes.items() if k not in ("_id", "version")}
+        changes["updated_at"] = utc_now()
+
+        # Reject values the typed snapshot could not load before storing them
+        current = await self.get()
+        try:
+            FinancialControls(**{**current.model_dump(), **changes})
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid financial controls: {e.errors()[0].get('msg')}")
+
+        doc = await db.financial_controls.find_one_and_update(
+            {},
+            {"$set": changes, "$inc": {"version": 1}},
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._controls = FinancialControls(**doc)
+        return self._controls
+
+    def invalidate(self):
+        self._controls = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _load(self) -> FinancialControls:
+        doc = await db.financial_controls.find_one({}, {"_id": 0})
+        if not doc:
+            doc = FinancialControls().model_dump()
+            await db.financial_controls.insert_one(doc.copy())
+        return FinancialControls(**doc)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self._controls is None:
+                continue
+            try:
+                doc = await db.financial_controls.find_one({}, {"_id": 0, "version": 1})
+            except Exception:
+                logger.exception("Failed to poll financial controls version")
+                continue
+            if (doc or {}).get("version", 0) != self._controls.version:
+                self.invalidate()
+
+financial_controls_cache = FinancialControlsCache(FINANCIAL_CONTROLS_POLL_SECONDS)
+
+# ==================== FINANCE SPEND LIMITS ====================
+
+# One counter document per finance officer per UTC day, keyed by _id, so
+# enforcing finance_daily_limit is a single guarded write and reading what
+# is left is a point lookup.
+MAX_SPEND_CHARGE_ATTEMPTS = 3
+
+def spend_counter_id(officer: str, day: datetime) -> str:
+    return f"{officer}:{day.strftime('%Y-%m-%d')}"
+
+async def charge_daily_spend(officer: str, amount: float, controls: FinancialControls) -> Dict[str, Any]:
+    """Count a payment against the officer's limits, or raise 400
+
+    The daily-limit check is part of the filter. When the counter exists
+    but would go over the limit, the filter does not match and the upsert
+    collides with the existing _id (duplicate key), which is how an exceeded
+    limit shows up. A first-of-day race on the insert is retried.
+    """
+    if amount > controls.finance_transaction_limit:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Amount (Br {amount:,.2f}) exceeds the per-transaction limit (Br {controls.finance_transaction_limit:,.2f})"
+        )
+
+    day = today_start_utc()
+    counter_id = spend_counter_id(officer, day)
+    daily_limit = controls.finance_daily_limit
+
+    if amount > daily_limit:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Amount (Br {amount:,.2f}) exceeds the daily limit (Br {daily_limit:,.2f})"
+        )
+
+    for attempt in range(MAX_SPEND_CHARGE_ATTEMPTS):
+        try:
+            return await db.finance_spend_counters.find_one_and_update(
+                {"_id": counter_id, "spent": {"$lte": daily_limit - amount}},
+                {
+                    "$inc": {"spent": amount, "payment_count": 1},
+                    "$set": {"updated_at": utc_now()},
+                    "$setOnInsert": {"officer": officer, "date": day}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            counter = await db.finance_spend_counters.find_one({"_id": counter_id}) or {}
+            spent = counter.get("spent", 0)
+            if spent + amount <= daily_limit and attempt + 1 < MAX_SPEND_CHARGE_ATTEMPTS:
+                continue
+            raise HTTPException(
+                status_code=400,
+                detail=f"Amount (Br {amount:,.2f}) exceeds the remaining daily limit (Br {max(daily_limit - spent, 0):,.2f})"
+            )
+
+async def refund_daily_spend(counter: Dict[str, Any], amount: float):
+    """Undo a charge_daily_spend whose payment did not go through"""
+    await db.finance_spend_counters.update_one(
+        {"_id": counter["_id"]},
+        {"$inc": {"spent": -amount, "payment_count": -1}, "$set": {"updated_at": utc_now()}}
+    )
+
+# ==================== TIMESTAMP MIGRATION ====================
+
+# Timestamp fields written by the API, per collection. Dotted paths reach into
+# sub-documents; if the parent is an array every element is converted.
+TIMESTAMP_FIELDS: Dict[str, List[str]] = {
+    "sales_transactions": ["created_at"],
+    "loans": ["created_at", "due_date", "last_payment_date"],
+    "loan_payments": ["payment_date"],
+    "inventory": ["last_updated"],
+    "stock_requests": [
+        "requested_at", "admin_approved_at", "manager_approved_at", "fulfilled_at",
+        "gate_verified_at", "gate_pass_approved_at", "delivered_at", "cancelled_at",
+        "dispatch_info.dispatched_at", "workflow_history.timestamp"
+    ],
+    "purchase_requisitions": [
+        "requested_at", "manager_approved_at", "admin_approved_at",
+        "owner_approved_at", "rejected_at", "completed_at"
+    ],
+    "payments": ["processed_at"],
+    "fund_requests": ["requested_at"],
+    "reconciliations": ["submitted_at"],
+    "wheat_deliveries": ["created_at"],
+    "milling_orders": ["created_at", "completed_at"],
+    "activity_logs": ["timestamp"],
+    "activity_logs_archive": ["timestamp"],
+    "financial_controls": ["updated_at"],
+    "finance_ledger": ["last_updated", "rebuilt_at"],
+    "customers": ["created_at", "updated_at", "last_purchase_at", "last_payment_at", "rebuilt_at"],
+    "loan_aging_summary": ["computed_at"],
+}
+
+def _convert_timestamp_fields(doc: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """Build a $set document converting string timestamps in `doc` to datetimes"""
+    updates: Dict[str, Any] = {}
+    for path in fields:
+        if "." not in path:
+            value = doc.get(path)
+            if isinstance(value, str) and parse_timestamp(value):
+                updates[path] = parse_timestamp(value)
+            continue
+
+        parent_name, child = path.split(".", 1)
+        parent = updates.get(parent_name, doc.get(parent_name))
+        if isinstance(parent, list):
+            changed = False
+            converted = []
+            for entry in parent:
+                if isinstance(entry, dict) and isinstance(entry.get(child), str) and parse_timestamp(entry[child]):
+                    entry = {**entry, child: parse_timestamp(entry[child])}
+                    changed = True
+                converted.append(entry)
+            if changed:
+                updates[parent_name] = converted
+        elif isinstance(parent, dict):
+            value = parent.get(child)
+            if isinstance(value, str) and parse_timestamp(value):
+                updates[path] = parse_timestamp(value)
+    return updates
+
+async def migrate_timestamps(batch_size: int = 500) -> Dict[str, int]:
+    """One-time migration converting string timestamps to native BSON dates
+
+    Safe to re-run: only documents that still hold string timestamps are
+    touched. Returns the number of documents updated per collection.
+    """
+    migrated = {}
+    existing = set(await db.list_collection_names())
+    for collection_name, fields in TIMESTAMP_FIELDS.items():
+        collection = db[collection_name]
+        if collection_name in existing and (await collection.options()).get("capped"):
+            # Capped collections reject updates that grow a document; the hot
+            # activity feed is a copy of activity_logs_archive, which is migrated
+            logger.info(f"Skipping capped collection {collection_name}")
+            continue
+        query = {"$or": [{path: {"$type": "string"}} for path in fields]}
+        projection = {path.split(".", 1)[0]: 1 for path in fields}
+
+        operations = []
+        count = 0
+        async for doc in collection.find(query, projection):
+            updates = _convert_timestamp_fields(doc, fields)
+            if not updates:
+                continue
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": updates}))
+            if len(operations) >= batch_size:
+                result = await collection.bulk_write(operations, ordered=False)
+                count += result.modified_count
+                operations = []
+        if operations:
+            result = await collection.bulk_write(operations, ordered=False)
+            count += result.modified_count
+
+        migrated[collection_name] = count
+        if count:
+            logger.info(f"Migrated {count} {collection_name} document(s) to native timestamps")
+    return migrated
+
+# ==================== INDEXES ====================
+
+# Declarative index registry: one entry per hot query shape. Applied
+# idempotently at startup; `python manage.py indexes` reports drift.
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    "sales_transactions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("branch_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="branch_created_at_id"),
+        IndexModel([("reconciliation_status", ASCENDING)], name="reconciliation_status"),
+    ],
+    "loans": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("customer_id", ASCENDING), ("status", ASCENDING)], name="customer_status"),
+        IndexModel(
+            [("customer_id", ASCENDING)],
+            name="customer_active_unique",
+            unique=True,
+            partialFilterExpression={"status": "active"}
+        ),
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("branch_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="branch_created_at_id"),
+    ],
+    "loan_payments": [
+        IndexModel([("loan_id", ASCENDING), ("payment_date", DESCENDING)], name="loan_payment_date"),
+        IndexModel([("payment_date", DESCENDING), ("id", DESCENDING)], name="payment_date_id"),
+        IndexModel([("branch_id", ASCENDING), ("payment_date", DESCENDING), ("id", DESCENDING)], name="branch_payment_date_id"),
+    ],
+    "inventory": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("name", ASCENDING), ("branch_id", ASCENDING)], name="name_branch"),
+        IndexModel([("branch_id", ASCENDING), ("category", ASCENDING)], name="branch_category"),
+        IndexModel([("name", ASCENDING), ("id", ASCENDING)], name="name_id"),
+        IndexModel([("branch_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)], name="branch_name_id"),
+    ],
+    "stock_requests": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("requested_at", DESCENDING), ("id", DESCENDING)], name="requested_at_id"),
+        IndexModel([("status", ASCENDING), ("requested_at", DESCENDING), ("id", DESCENDING)], name="status_requested_at_id"),
+        IndexModel([("source_branch", ASCENDING), ("requested_at", DESCENDING), ("id", DESCENDING)], name="source_branch_requested_at_id"),
+        IndexModel([("is_customer_delivery", ASCENDING), ("requested_at", DESCENDING), ("id", DESCENDING)], name="customer_delivery_requested_at_id"),
+        IndexModel([("batch_id", ASCENDING)], name="batch_id", sparse=True),
+    ],
+    "purchase_requisitions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("requested_at", DESCENDING)], name="status_requested_at"),
+        IndexModel([("branch_id", ASCENDING), ("requested_at", DESCENDING)], name="branch_requested_at"),
+        IndexModel([("batch_number", ASCENDING)], name="batch_number", sparse=True),
+    ],
+    "milling_orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("branch_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="branch_created_at_id"),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="status_created_at_id"),
+    ],
+    "fund_requests": [
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("requisition_id", ASCENDING)], name="requisition_id"),
+    ],
+    "payments": [
+        IndexModel([("requisition_id", ASCENDING)], name="requisition_id"),
+        IndexModel([("processed_at", DESCENDING), ("id", DESCENDING)], name="processed_at_id"),
+    ],
+    "activity_logs": [
+        IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+    ],
+    "activity_logs_archive": [
+        IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp_id"),
+        IndexModel([("branch", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="branch_timestamp_id"),
+    ],
+    "finance_ledger": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "customers": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("name_lower", ASCENDING), ("id", ASCENDING)], name="name_lower_id"),
+        IndexModel([("phone", ASCENDING), ("id", ASCENDING)], name="phone_id"),
+    ],
+    "loan_aging_summary": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "idempotency_keys": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+async def ensure_indexes() -> Dict[str, List[str]]:
+    """Create every registered index that does not exist yet
+
+    Each index is created on its own so one failure (e.g. duplicate ids
+    blocking a unique index) is logged without blocking the others.
+    Returns the names of the indexes that could not be created.
+    """
+    failed: Dict[str, List[str]] = {}
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        for index in indexes:
+            try:
+                await db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                name = index.document["name"]
+                logger.warning(f"Could not create index {collection_name}.{name}: {e}")
+                failed.setdefault(collection_name, []).append(name)
+    return failed
+
+async def index_report() -> Dict[str, Dict[str, Any]]:
+    """Compare registered indexes with what exists in the database
+
+    Reports, per collection, registered indexes that are missing, indexes
+    that exist but are not registered, and indexes with no recorded
+    accesses since the server last restarted (from $indexStats).
+    """
+    report = {}
+    collection_names = set(await db.list_collection_names())
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        expected = {index.document["name"] for index in indexes}
+        existing = set()
+        unused = []
+        if collection_name in collection_names:
+            existing = set((await db[collection_name].index_information()).keys())
+            try:
+                async for stat in db[collection_name].aggregate([{"$indexStats": {}}]):
+                    if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0:
+                        unused.append(stat["name"])
+            except OperationFailure as e:
+                logger.warning(f"$indexStats unavailable for {collection_name}: {e}")
+        existing.discard("_id_")
+        report[collection_name] = {
+            "missing": sorted(expected - existing),
+            "unregistered": sorted(existing - expected),
+            "unused": sorted(unused),
+        }
+    return report
+
+# ==================== IDEMPOTENCY ====================
+
+# A POST carrying an Idempotency-Key header is executed once; retries with
+# the same key (and body) get the stored first response replayed instead of
+# booking the sale/payment again. Keys are scoped to the request path and
+# expire from `idempotency_keys` via a TTL index. An attempt holds the key
+# under a short lease, so a retry can take over from a worker that died
+# mid-request instead of waiting out the TTL.
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', 120))
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+REPLAYED_HEADERS = ("content-type", "x-next-cursor")
+
+# Streaming uploads are never buffered for hashing
+IDEMPOTENCY_EXEMPT_PREFIXES = ("/api/import/",)
+
+def idempotency_error(status_code: int, detail: str) -> Response:
+    return Response(
+        content=json.dumps({"detail": detail}),
+        status_code=status_code,
+        media_type="application/json"
+    )
+
+async def idempotency_middleware(request: Request, call_next):
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if request.method != "POST" or not key or request.url.path.startswith(IDEMPOTENCY_EXEMPT_PREFIXES):
+        return await call_next(request)
+
+    if len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        return idempotency_error(400, f"{IDEMPOTENCY_HEADER} must be at most {MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+
+    body = await request.body()
+    request_hash = hashlib.sha256(
+        f"{request.url.path}?{request.url.query}\n".encode() + body
+    ).hexdigest()
+    record_id = f"{request.url.path}:{key}"
+    owner = str(uuid.uuid4())
+    now = utc_now()
+    lease = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+
+    # Claim the key; losing the insert race means another attempt owns it
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": record_id,
+            "request_hash": request_hash,
+            "state": "in_progress",
+            "owner": owner,
+            "locked_until": lease,
+            "created_at": now,
+            "expires_at": now + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+        })
+    except DuplicateKeyError:
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if not record:
+            return idempotency_error(409, "Request with this Idempotency-Key expired mid-flight; retry")
+        if record["request_hash"] != request_hash:
+            return idempotency_error(422, f"{IDEMPOTENCY_HEADER} was already used with a different request body")
+        if record["state"] == "completed":
+            response = Response(content=record["body"], status_code=record["status_code"])
+            response.headers.update(record.get("headers", {}))
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+        # Take over only once the previous attempt's lease has run out
+        taken = await db.idempotency_keys.find_one_and_update(
+            {"_id": record_id, "state": "in_progress", "locked_until": {"$not": {"$gt": now}}},
+            {"$set": {"owner": owner, "locked_until": lease}}
+        )
+        if not taken:
+            return idempotency_error(409, "A request with this Idempotency-Key is still being processed")
+
+    try:
+        response = await call_next(request)
+        content = b"".join([chunk async for chunk in response.body_iterator])
+    except Exception:
+        await db.idempotency_keys.delete_one({"_id": record_id, "owner": owner})
+        raise
+
+    # Writes are scoped to our lease so a takeover's record is never clobbered
+    if 200 <= response.status_code < 300:
+        await db.idempotency_keys.update_one(
+            {"_id": record_id, "owner": owner},
+            {"$set": {
+                "state": "completed",
+                "status_code": response.status_code,
+                "body": content,
+                "headers": {h: response.headers[h] for h in REPLAYED_HEADERS if h in response.headers},
+                "completed_at": utc_now()
+            }}
+        )
+    else:
+        # Nothing was booked; let the client retry with the same key
+        await db.idempotency_keys.delete_one({"_id": record_id, "owner": owner})
+
+    return Response(
+        content=content,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        media_type=response.media_type
+    )
+
+# ==================== PAGINATION ====================
+
+# List endpoints return at most `limit` documents ordered by (sort_field, id).
+# The body stays a plain JSON array; when more rows exist the opaque cursor
+# for the next page is sent in the X-Next-Cursor response header.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(doc: Dict[str, Any], sort_field: str) -> str:
+    """Encode the keyset position after `doc` as an opaque cursor"""
+    value = doc.get(sort_field)
+    payload = {
+        "v": value.isoformat() if isinstance(value, datetime) else value,
+        "dt": isinstance(value, datetime),
+        "id": doc.get("id")
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor: str):
+    """Decode a cursor into its (sort value, id) keyset position"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(payload, dict):
+            raise ValueError("cursor payload must be an object")
+        value = parse_timestamp(payload["v"]) if payload.get("dt") else payload["v"]
+        return value, payload["id"]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def paginate(
+    collection,
+    query: Dict[str, Any],
+    response: Response,
+    sort_field: str,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    direction: int = DESCENDING
+) -> List[Dict[str, Any]]:
+    """Fetch one keyset page and set X-Next-Cursor if more rows exist"""
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        op = "$lt" if direction == DESCENDING else "$gt"
+        keyset = {"$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "id": {op: last_id}}
+        ]}
+        query = {"$and": [query, keyset]} if query else keyset
+
+    items = await collection.find(query, {"_id": 0}).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+
+    if len(items) > limit:
+        items = items[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(items[-1], sort_field)
+
+    return items
 
 async def initialize_sample_data():
     """Initialize sample data if database is empty"""
@@ -250,7 +1222,7 @@ async def initialize_sample_data():
                 "current_unit_cost": 25,
                 "unit_selling_price": 0,
                 "reorder_level": 5000,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             }
             await db.inventory.insert_one(wheat_item)
         
@@ -285,7 +1257,7 @@ async def initialize_sample_data():
                     "current_unit_cost": unit_cost,
                     "unit_selling_price": selling_price,
                     "reorder_level": 500,
-                    "last_updated": datetime.now(timezone.utc).isoformat()
+                    "last_updated": utc_now()
                 }
                 await db.inventory.insert_one(product_item)
     
@@ -306,7 +1278,7 @@ async def initialize_sample_data():
                 "current_unit_cost": 35,
                 "unit_selling_price": 45,
                 "reorder_level": 1000,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             },
             {
                 "id": "inv_002",
@@ -320,7 +1292,7 @@ async def initialize_sample_data():
                 "current_unit_cost": 40,
                 "unit_selling_price": 52,
                 "reorder_level": 800,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             },
             {
                 "id": "inv_003",
@@ -334,7 +1306,7 @@ async def initialize_sample_data():
                 "current_unit_cost": 25,
                 "unit_selling_price": 0,
                 "reorder_level": 5000,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             },
             {
                 "id": "inv_004",
@@ -348,7 +1320,7 @@ async def initialize_sample_data():
                 "current_unit_cost": 35,
                 "unit_selling_price": 45,
                 "reorder_level": 1000,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             },
             {
                 "id": "inv_005",
@@ -362,7 +1334,7 @@ async def initialize_sample_data():
                 "current_unit_cost": 40,
                 "unit_selling_price": 52,
                 "reorder_level": 800,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             },
             {
                 "id": "inv_006",
@@ -376,7 +1348,7 @@ async def initialize_sample_data():
                 "current_unit_cost": 25,
                 "unit_selling_price": 0,
                 "reorder_level": 5000,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             }
         ]
         await db.inventory.insert_many(sample_inventory)
@@ -402,24 +1374,18 @@ async def health_check():
 
 @api_router.get("/finance/summary")
 async def get_finance_summary():
-    """Get financial summary"""
-    
-    # Get all sales transactions
-    transactions = await db.sales_transactions.find({}, {"_id": 0}).to_list(1000)
-    
-    # Get all loans
-    loans = await db.loans.find({"status": "active"}, {"_id": 0}).to_list(1000)
-    
-    # Get pending requisitions (both admin_approved and owner_approved)
-    requisitions = await db.purchase_requisitions.find(
-        {"status": {"$in": ["admin_approved", "owner_approved"]}}, 
-        {"_id": 0}
-    ).to_list(1000)
-    
-    total_sales = sum(txn.get('total_amount', 0) for txn in transactions)
-    accounts_receivable = sum(loan.get('balance', 0) for loan in loans)
-    pending_payments = sum(req.get('estimated_cost', 0) for req in requisitions)
-    
+    """Get financial summary
+
+    Reads the running totals maintained by the sales, loan, approval and
+    payment handlers instead of scanning history.
+    """
+
+    ledger = await get_finance_ledger()
+
+    total_sales = ledger.get("total_income", 0)
+    accounts_receivable = ledger.get("accounts_receivable", 0)
+    pending_payments = ledger.get("pending_payables", 0)
+
     return {
         "cash_account": total_sales * 0.7,  # Mock: 70% of sales as cash
         "bank_account": total_sales * 0.3,  # Mock: 30% in bank
@@ -428,9 +1394,16 @@ async def get_finance_summary():
         "net_balance": total_sales - pending_payments,
         "accounts_receivable": accounts_receivable,
         "pending_payments": pending_payments,
-        "pending_count": len(requisitions)
+        "pending_count": ledger.get("pending_payables_count", 0)
     }
 
+@api_router.post("/finance/ledger/rebuild")
+async def rebuild_finance_summary():
+    """Recompute the finance ledger totals from scratch"""
+    ledger = await rebuild_finance_ledger()
+    await log_activity("Finance", "ledger_rebuild", "Rebuilt finance ledger totals")
+    return {"success": True, "ledger": ledger}
+
 @api_router.get("/finance/pending-authorizations")
 async def get_pending_authorizations():
     """Get purchase requisitions awaiting payment
@@ -489,7 +1462,7 @@ async def submit_reconciliation(data: Dict[str, Any]):
         "variance": data.get("variance", 0),
         "notes": data.get("notes", ""),
         "submitted_by": data.get("submitted_by", "Unknown"),
-        "submitted_at": datetime.now(timezone.utc).isoformat(),
+        "submitted_at": utc_now(),
         "status": "submitted"
     }
     
@@ -504,16 +1477,19 @@ async def submit_reconciliation(data: Dict[str, Any]):
 @api_router.get("/finance/spending-limits")
 async def get_spending_limits(finance_officer: str = Query(...)):
     """Get spending limits for finance officer"""
-    controls = await db.financial_controls.find_one({}, {"_id": 0})
-    
-    if not controls:
-        controls = FinancialControls().model_dump()
+    controls = await financial_controls_cache.get()
+    counter = await db.finance_spend_counters.find_one(
+        {"_id": spend_counter_id(finance_officer, today_start_utc())}
+    ) or {}
+    spent = counter.get("spent", 0)
     
     return {
         "finance_officer": finance_officer,
-        "daily_limit": controls.get("finance_daily_limit", 500000),
-        "transaction_limit": controls.get("finance_transaction_limit", 100000),
-        "remaining_daily_limit": controls.get("finance_daily_limit", 500000) * 0.65  # Mock: 65% remaining
+        "daily_limit": controls.finance_daily_limit,
+        "transaction_limit": controls.finance_transaction_limit,
+        "spent_today": spent,
+        "payments_today": counter.get("payment_count", 0),
+        "remaining_daily_limit": max(controls.finance_daily_limit - spent, 0)
     }
 
 @api_router.post("/finance/process-payment/{requisition_id}")
@@ -538,6 +1514,13 @@ async def process_payment(requisition_id: str, payment_data: Dict[str, Any]):
             detail=f"Requisition not approved for payment. Current status: {requisition.get('status')}"
         )
     
+    amount = requisition.get("estimated_cost", 0)
+    processed_by = payment_data.get("processed_by", "Finance Officer")
+    
+    # Enforce the officer's transaction and daily limits in one guarded write
+    controls = await financial_controls_cache.get()
+    counter = await charge_daily_spend(processed_by, amount, controls)
+    
     # Create payment record
     payment = {
         "id": str(uuid.uuid4()),
@@ -546,27 +1529,39 @@ async def process_payment(requisition_id: str, payment_data: Dict[str, Any]):
         "payment_method": payment_data.get("payment_method"),
         "bank_name": payment_data.get("bank_name"),
         "reference_number": payment_data.get("reference_number"),
-        "processed_by": payment_data.get("processed_by", "Finance Officer"),
-        "processed_at": datetime.now(timezone.utc).isoformat(),
+        "processed_by": processed_by,
+        "processed_at": utc_now(),
         "notes": payment_data.get("notes", ""),
         "status": "completed"
     }
     
-    # Make a copy for response
-    response_data = payment.copy()
-    
-    await db.payments.insert_one(payment)
-    
-    # Update requisition status
-    await db.purchase_requisitions.update_one(
-        {"id": requisition_id},
+    # Update requisition status, unless a concurrent payment got there first
+    claimed = await db.purchase_requisitions.find_one_and_update(
+        {"id": requisition_id, "status": {"$in": ["admin_approved", "owner_approved"]}},
         {"$set": {
             "status": "completed", 
             "payment_id": payment["id"],
-            "completed_at": datetime.now(timezone.utc).isoformat()
-        }}
+            "completed_at": utc_now()
+        }},
+        projection={"_id": 0, "status": 1}
     )
     
+    if not claimed:
+        await refund_daily_spend(counter, amount)
+        raise HTTPException(status_code=409, detail="Requisition was already paid")
+    
+    # Make a copy for response
+    response_data = payment.copy()
+    
+    await db.payments.insert_one(payment)
+
+    await update_finance_ledger(
+        pending_payables=-amount,
+        pending_payables_count=-1,
+        total_paid_out=amount,
+        payment_count=1
+    )
+
     # Log activity with approval source
     approval_source = "Admin" if requisition.get('status') == 'admin_approved' else "Owner"
     await log_activity(
@@ -589,7 +1584,7 @@ async def request_funds(requisition_id: str, request_data: Dict[str, Any]):
         "requested_by": request_data.get("requested_by"),
         "payment_urgency": request_data.get("payment_urgency", "normal"),
         "justification": request_data.get("justification"),
-        "requested_at": datetime.now(timezone.utc).isoformat(),
+        "requested_at": utc_now(),
         "status": "pending"
     }
     
@@ -604,55 +1599,40 @@ async def request_funds(requisition_id: str, request_data: Dict[str, Any]):
 
 @api_router.get("/owner/dashboard-summary")
 async def get_owner_dashboard_summary():
-    """Get owner dashboard summary"""
-    
-    # Get today's date range
-    today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # Get sales
-    all_transactions = await db.sales_transactions.find({}, {"_id": 0}).to_list(1000)
-    
-    # Filter today's transactions safely
-    today_transactions = []
-    for t in all_transactions:
-        created_at = t.get('created_at')
-        if created_at:
-            try:
-                if isinstance(created_at, str):
-                    txn_date = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                else:
-                    txn_date = created_at
-                if txn_date >= today_start:
-                    today_transactions.append(t)
-            except (ValueError, AttributeError):
-                continue
-    
-    # Get loans
-    loans = await db.loans.find({"status": "active"}, {"_id": 0}).to_list(1000)
+    """Get owner dashboard summary
+
+    All KPIs are computed inside MongoDB; only the final numbers are returned.
+    """
     
-    # Get inventory
-    inventory = await db.inventory.find({}, {"_id": 0}).to_list(1000)
+    # Today's sales
+    today_sales = await (
+        Pipeline()
+        .match({"created_at": {"$gte": today_start_utc()}})
+        .group(None, total=sum_of("total_amount"))
+        .first(db.sales_transactions, {"total": 0})
+    )
     
-    # Get fund requests
-    fund_requests = await db.fund_requests.find({"status": "pending"}, {"_id": 0}).to_list(100)
+    # Inventory value
+    inventory = await (
+        Pipeline()
+        .group(None, total=sum_of(multiply("quantity", "current_unit_cost")))
+        .first(db.inventory, {"total": 0})
+    )
     
-    total_sales = sum(t.get('total_amount', 0) for t in all_transactions)
-    today_sales = sum(t.get('total_amount', 0) for t in today_transactions)
-    accounts_receivable = sum(l.get('balance', 0) for l in loans)
+    # Lifetime sales and receivables come from the finance ledger
+    ledger = await get_finance_ledger()
     
-    inventory_value = sum(
-        item.get('quantity', 0) * item.get('current_unit_cost', 0)
-        for item in inventory
-    )
+    total_sales = ledger.get("total_income", 0)
+    accounts_receivable = ledger.get("accounts_receivable", 0)
     
     return {
         "financial_kpis": {
             "cash_in_bank": total_sales * 0.75,
-            "todays_sales": today_sales,
+            "todays_sales": today_sales["total"],
             "accounts_receivable": accounts_receivable,
             "gross_profit": total_sales * 0.3,
-            "pending_fund_requests": len(fund_requests),
-            "inventory_value": inventory_value
+            "pending_fund_requests": await db.fund_requests.count_documents({"status": "pending"}),
+            "inventory_value": inventory["total"]
         },
         "operations": {
             "total_staff": 45,
@@ -665,47 +1645,49 @@ async def get_owner_dashboard_summary():
         }
     }
 
+# Staff headcount per branch (not tracked in the database yet)
+BRANCH_STAFF = {"berhane": 22, "girmay": 18}
+
 @api_router.get("/owner/branch-stats")
 async def get_branch_stats():
-    """Get statistics for all branches"""
+    """Get statistics for all branches
+
+    One aggregation covers every branch: finished-product inventory and
+    today's sales are unioned into a single $group by branch_id, so the
+    branch list comes from the data and cost doesn't grow per branch.
+    """
     
-    branches = ["berhane", "girmay"]
-    stats = {}
+    rows = await (
+        Pipeline()
+        .project(
+            branch_id=1,
+            inventory=cond({"$eq": ["$category", "Finished Product"]}, "$quantity"),
+            sales={"$literal": 0}
+        )
+        .union_with(
+            "sales_transactions",
+            Pipeline()
+            .match({"created_at": {"$gte": today_start_utc()}})
+            .project(branch_id=1, inventory={"$literal": 0}, sales="$total_amount")
+        )
+        .match({"branch_id": {"$ne": None}})
+        .group("branch_id", current_inventory=sum_of("inventory"), today_sales=sum_of("sales"))
+        .sort(_id=1)
+        .run(db.inventory)
+    )
     
-    for branch_id in branches:
-        # Get branch inventory
-        inventory = await db.inventory.find({"branch_id": branch_id}, {"_id": 0}).to_list(100)
-        
-        # Get branch sales
-        transactions = await db.sales_transactions.find({"branch_id": branch_id}, {"_id": 0}).to_list(1000)
-        
-        today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Calculate today's sales safely
-        today_sales = 0
-        for t in transactions:
-            created_at = t.get('created_at')
-            if created_at:
-                try:
-                    if isinstance(created_at, str):
-                        txn_date = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                    else:
-                        txn_date = created_at
-                    if txn_date >= today_start:
-                        today_sales += t.get('total_amount', 0)
-                except (ValueError, AttributeError):
-                    continue
-        
-        total_inventory = sum(item.get('quantity', 0) for item in inventory if item.get('category') == 'Finished Product')
-        
+    stats = {}
+    for row in rows:
+        branch_id = row["_id"]
+        total_inventory = row["current_inventory"]
         stats[branch_id] = {
             "branch_id": branch_id,
             "branch_name": f"{branch_id.capitalize()} Branch",
-            "today_sales": today_sales,
+            "today_sales": row["today_sales"],
             "today_production": total_inventory * 0.1,  # Mock production
             "current_inventory": total_inventory,
             "operational_status": "Active",
-            "active_staff": 22 if branch_id == "berhane" else 18
+            "active_staff": BRANCH_STAFF.get(branch_id, 0)
         }
     
     return stats
@@ -713,14 +1695,43 @@ async def get_branch_stats():
 @api_router.get("/owner/activity-feed")
 async def get_activity_feed(limit: int = Query(50, ge=1, le=100)):
     """Get recent activity feed"""
-    activities = await db.activity_logs.find({}, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(limit)
-    return activities
+    return await recent_activity(limit)
+
+@api_router.get("/owner/activity-stream")
+async def get_activity_stream(request: Request):
+    """Live activity feed as Server-Sent Events (replaces polling the feed)"""
+    return StreamingResponse(
+        stream_activity(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @api_router.get("/recent-activity")
 async def get_recent_activity(limit: int = Query(10, ge=1, le=100)):
     """Get recent activity - alternative endpoint"""
-    activities = await db.activity_logs.find({}, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(limit)
-    return activities
+    return await recent_activity(limit)
+
+@api_router.get("/activity-logs/archive")
+async def get_activity_log_archive(
+    response: Response,
+    branch: Optional[str] = None,
+    role: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Full activity history, newest first"""
+    query = {}
+    if branch:
+        query["branch"] = branch
+    if role:
+        query["role"] = role
+    
+    return await paginate(db.activity_logs_archive, query, response, "timestamp", cursor, limit)
+
+@api_router.get("/metrics/activity-log")
+async def get_activity_log_metrics():
+    """Queue depth and flush/drop counters for the buffered activity logger"""
+    return activity_log_buffer.metrics()
 
 @api_router.get("/owner/pending-fund-requests")
 async def get_pending_fund_requests():
@@ -728,27 +1739,23 @@ async def get_pending_fund_requests():
     fund_requests = await db.fund_requests.find({"status": "pending"}, {"_id": 0}).to_list(100)
     
     # Enrich with requisition data
-    for request in fund_requests:
-        req_id = request.get("requisition_id")
-        if req_id:
-            requisition = await db.purchase_requisitions.find_one({"id": req_id}, {"_id": 0})
-            if requisition:
-                request["requisition"] = requisition
-    
-    return fund_requests
+    return await attach_related(fund_requests, "requisition_id", db.purchase_requisitions, "requisition")
 
 # ==================== INVENTORY MODULE ====================
 
 @api_router.get("/inventory")
-async def get_inventory(branch_id: Optional[str] = None):
-    """Get inventory items, optionally filtered by branch"""
+async def get_inventory(
+    response: Response,
+    branch_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Get inventory items, optionally filtered by branch (paged by name)"""
     query = {}
     if branch_id:
         query["branch_id"] = branch_id
     
-    # Exclude MongoDB's _id field to avoid serialization issues
-    inventory = await db.inventory.find(query, {"_id": 0}).to_list(1000)
-    return inventory
+    return await paginate(db.inventory, query, response, "name", cursor, limit, direction=ASCENDING)
 
 @api_router.get("/inventory/valuation")
 async def get_inventory_valuation():
@@ -834,7 +1841,7 @@ async def update_inventory_pricing(item_id: str, pricing_data: Dict[str, Any]):
     if "unit_selling_price" in pricing_data:
         update_fields["unit_selling_price"] = pricing_data["unit_selling_price"]
     
-    update_fields["last_updated"] = datetime.now(timezone.utc).isoformat()
+    update_fields["last_updated"] = utc_now()
     
     result = await db.inventory.update_one(
         {"id": item_id},
@@ -846,21 +1853,369 @@ async def update_inventory_pricing(item_id: str, pricing_data: Dict[str, Any]):
     
     return {"success": True, "updated_fields": update_fields}
 
-# ==================== SALES MODULE ====================
+# ==================== INVENTORY RESERVATION ====================
 
-@api_router.post("/sales-transactions")
-async def create_sales_transaction(transaction_data: Dict[str, Any]):
-    """Create a new sales transaction"""
+# Stock is only ever decremented with a guarded update ("quantity >= qty"), so
+# concurrent sales across uvicorn workers can never drive inventory negative.
+# Partially applied reservations are compensated before an error is returned.
+MAX_RESERVATION_ATTEMPTS = 3
+
+def aggregate_inventory_lines(branch_id: str, items: List[Dict[str, Any]]) -> Dict[tuple, float]:
+    """Sum sale line quantities per (product_id, branch_id)"""
+    demands: Dict[tuple, float] = {}
+    for item in items:
+        quantity = item.get("quantity_kg", 0)
+        if quantity > 0:
+            key = (item.get("product_id"), branch_id)
+            demands[key] = demands.get(key, 0) + quantity
+    return demands
+
+async def release_inventory(demands: Dict[tuple, float]):
+    """Give back previously reserved stock"""
+    if demands:
+        await db.inventory.bulk_write([
+            UpdateOne({"id": product_id, "branch_id": branch_id}, {"$inc": {"quantity": quantity}})
+            for (product_id, branch_id), quantity in demands.items()
+        ], ordered=False)
+
+async def reserve_inventory(branch_id: str, items: List[Dict[str, Any]], allow_backorder: bool = False) -> List[Dict[str, Any]]:
+    """Atomically decrement stock for a sale's lines
+
+    Each product is decremented only if enough stock is on hand. If a line
+    cannot be satisfied the lines already reserved are released and a 409 is
+    raised, unless `allow_backorder` is set, in which case the short lines
+    are left untouched and returned as back-ordered.
+    """
+    reserved: Dict[tuple, float] = {}
+    backordered = []
     
-    # Calculate total
-    items = transaction_data.get("items", [])
-    total_amount = sum(item.get('quantity_kg', 0) * item.get('unit_price', 0) for item in items)
+    for (product_id, line_branch), quantity in aggregate_inventory_lines(branch_id, items).items():
+        result = await db.inventory.update_one(
+            {"id": product_id, "branch_id": line_branch, "quantity": {"$gte": quantity}},
+            {"$inc": {"quantity": -quantity}}
+        )
+        if result.modified_count:
+            reserved[(product_id, line_branch)] = quantity
+        elif allow_backorder:
+            backordered.append({"product_id": product_id, "quantity_kg": quantity})
+        else:
+            await release_inventory(reserved)
+            raise HTTPException(
+                status_code=409,
+                detail=f"Insufficient stock for product {product_id} in {line_branch} branch (requested {quantity}kg)"
+            )
+    
+    return backordered
+
+async def reserve_inventory_batch(orders: List[tuple]) -> List[Optional[List[Dict[str, Any]]]]:
+    """Reserve stock for many sales against one inventory snapshot
+
+    `orders` is a list of (branch_id, items, allow_backorder). Orders are
+    allocated in sequence against one inventory snapshot. The result holds
+    one entry per order: None if it was rejected for insufficient stock,
+    otherwise the list of back-ordered lines.
+
+    One guarded decrement per product is sent concurrently. If any guard
+    no longer holds (stock sold or the row removed since the snapshot),
+    the decrements that did match are released and the allocation is
+    retried.
+    """
+    product_ids = list({
+        key[0]
+        for branch_id, items, _ in orders
+        for key in aggregate_inventory_lines(branch_id, items)
+    })
+    
+    for _ in range(MAX_RESERVATION_ATTEMPTS):
+        snapshot = {
+            (doc["id"], doc["branch_id"]): doc
+            for doc in await db.inventory.find(
+                {"id": {"$in": product_ids}},
+                {"_id": 1, "id": 1, "branch_id": 1, "quantity": 1}
+            ).to_list(None)
+        }
+        available = {key: doc.get("quantity", 0) for key, doc in snapshot.items()}
+        
+        totals: Dict[tuple, float] = {}
+        outcomes: List[Optional[List[Dict[str, Any]]]] = []
+        for branch_id, items, allow_backorder in orders:
+            demands = aggregate_inventory_lines(branch_id, items)
+            short = {key for key, quantity in demands.items() if available.get(key, 0) < quantity}
+            if short and not allow_backorder:
+                outcomes.append(None)
+                continue
+            for key, quantity in demands.items():
+                if key not in short:
+                    available[key] -= quantity
+                    totals[key] = totals.get(key, 0) + quantity
+            outcomes.append([{"product_id": key[0], "quantity_kg": demands[key]} for key in short])
+        
+        if not totals:
+            return outcomes
+        
+        ordered_totals = list(totals.items())
+        results = await asyncio.gather(*(
+            db.inventory.update_one(
+                {"_id": snapshot[key]["_id"], "quantity": {"$gte": quantity}},
+                {"$inc": {"quantity": -quantity}}
+            )
+            for key, quantity in ordered_totals
+        ))
+        if sum(result.matched_count for result in results) == len(ordered_totals):
+            return outcomes
+        
+        await release_inventory({
+            key: quantity
+            for (key, quantity), result in zip(ordered_totals, results)
+            if result.matched_count
+        })
+        logger.info("Inventory changed during batch reservation, retrying")
+    
+    raise HTTPException(status_code=409, detail="Inventory changed concurrently, please retry the batch")
+
+# ==================== CUSTOMER DIRECTORY ====================
+
+# `customers` is a materialized view of credit customers, kept current by
+# the sales and loan-payment paths and rebuildable from loans and sales
+# with `python manage.py rebuild-customers`.
+CUSTOMER_COUNTERS = ("total_loans", "total_balance", "total_purchases", "total_spent")
+
+def customer_update(
+    data: Dict[str, Any],
+    inc: Dict[str, float],
+    set_fields: Optional[Dict[str, Any]] = None,
+    purchased_at: Optional[datetime] = None
+) -> tuple:
+    """Filter and upsert update applying running-total changes to a customer"""
+    now = utc_now()
+    changes = {"updated_at": now, **(set_fields or {})}
+    if data.get("customer_name"):
+        changes["name"] = data["customer_name"]
+        changes["name_lower"] = data["customer_name"].lower()
+    if data.get("customer_phone"):
+        changes["phone"] = data["customer_phone"]
+
+    inc = {key: value for key, value in inc.items() if value}
+    defaults = {"created_at": now, "payment_rating": "New Customer", "name": "", "name_lower": "", "phone": ""}
+    defaults.update({counter: 0 for counter in CUSTOMER_COUNTERS})
+
+    update: Dict[str, Any] = {
+        "$set": changes,
+        "$setOnInsert": {key: value for key, value in defaults.items() if key not in changes and key not in inc}
+    }
+    if inc:
+        update["$inc"] = inc
+    if purchased_at:
+        update["$max"] = {"last_purchase_at": purchased_at}
+    return {"id": data["customer_id"]}, update
+
+async def record_customer_activity(data: Dict[str, Any], **kwargs):
+    """Apply customer_update() for one customer, creating the entry if needed"""
+    if not data.get("customer_id"):
+        return
+    filter_, update = customer_update(data, **kwargs)
+    try:
+        await db.customers.update_one(filter_, update, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent sale created the entry first; apply on top of it
+        await db.customers.update_one(filter_, update, upsert=True)
+
+def credit_authorization(data: Dict[str, Any], amount: float, default_limit: float) -> tuple:
+    """customer_update() holding `amount` of credit, guarded by limit and overdue flag
+
+    The guard is part of the filter, so checking the exposure and taking the
+    hold are one atomic write on the customer's directory entry. The filter
+    uses $expr, which MongoDB does not allow in an upsert, so the entry must
+    already exist (see authorize_credit()).
+    """
+    filter_, update = customer_update(data, inc={"total_balance": amount})
+    update.pop("$setOnInsert")
+    filter_.update({
+        "overdue": {"$ne": True},
+        "$expr": {"$lte": [
+            {"$add": [{"$ifNull": ["$total_balance", 0]}, amount]},
+            {"$ifNull": ["$credit_limit", default_limit]}
+        ]}
+    })
+    return filter_, update
+
+async def ensure_customer_entry(data: Dict[str, Any]):
+    """Create the customer's directory entry with zeroed totals if it is missing"""
+    filter_, update = customer_update(data, inc={})
+    try:
+        await db.customers.update_one(
+            filter_, {"$setOnInsert": {**update["$setOnInsert"], **update["$set"]}}, upsert=True
+        )
+    except DuplicateKeyError:
+        # A concurrent sale created it first
+        pass
+
+async def authorize_credit(data: Dict[str, Any], amount: float):
+    """Hold `amount` against the customer's credit limit, or raise 400
+
+    The entry is created first (a plain $setOnInsert upsert) so the hold
+    itself can be a non-upsert guarded write.
+    """
+    controls = await financial_controls_cache.get()
+    default_limit = controls.default_customer_credit_limit
+
+    # Only an existing entry can carry a limit above the default
+    if amount <= default_limit:
+        await ensure_customer_entry(data)
+
+    filter_, update = credit_authorization(data, amount, default_limit)
+    held = await db.customers.find_one_and_update(filter_, update, projection={"_id": 1})
+    if held is not None:
+        return
+
+    customer = await db.customers.find_one(
+        {"id": data["customer_id"]},
+        {"_id": 0, "total_balance": 1, "credit_limit": 1, "overdue": 1}
+    ) or {}
+    if customer.get("overdue"):
+        raise HTTPException(status_code=400, detail="Customer has overdue loans; credit sale not allowed")
+    limit = customer.get("credit_limit", default_limit)
+    available = max(limit - customer.get("total_balance", 0), 0)
+    raise HTTPException(
+        status_code=400,
+        detail=f"Amount (Br {amount:,.2f}) exceeds available credit (Br {available:,.2f})"
+    )
+
+async def release_credit(customer_id: str, amount: float):
+    """Give back credit held by authorize_credit() for a sale that was not recorded"""
+    if amount:
+        await db.customers.update_one({"id": customer_id}, {"$inc": {"total_balance": -amount}})
+
+async def bulk_record_customer_activity(updates: List[tuple]):
+    """Apply many customer_update() pairs with one unordered bulk_write"""
+    if not updates:
+        return
+    operations = [UpdateOne(filter_, update, upsert=True) for filter_, update in updates]
+    try:
+        await db.customers.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        retry = [operations[error["index"]] for error in e.details.get("writeErrors", []) if error.get("code") == 11000]
+        if len(retry) < len(e.details.get("writeErrors", [])):
+            raise
+        await db.customers.bulk_write(retry, ordered=False)
+
+def _latest(value_field: str) -> Dict[str, Any]:
+    """$max accumulator picking `value_field` from the newest document having it"""
+    return {"$max": {"$cond": [
+        {"$ifNull": [f"${value_field}", False]},
+        ["$created_at", f"${value_field}"],
+        None
+    ]}}
+
+async def rebuild_customers() -> int:
+    """Recompute the customer directory from loans and sales transactions"""
+    await db.customers.create_indexes(INDEX_REGISTRY["customers"])
+    rebuilt_at = utc_now()
+    has_customer = {"customer_id": {"$nin": [None, ""]}}
+
+    await (
+        Pipeline()
+        .match(has_customer)
+        .project(
+            _id=0, customer_id=1, created_at=1,
+            name="$customer_name", phone="$customer_phone", rating="$payment_history_rating",
+            loans={"$literal": 1}, balance={"$ifNull": ["$balance", 0]},
+            purchases={"$literal": 0}, spent={"$literal": 0}
+        )
+        .union_with("sales_transactions", Pipeline().match(has_customer).project(
+            _id=0, customer_id=1, created_at=1,
+            name="$customer_name", purchased_at="$created_at",
+            loans={"$literal": 0}, balance={"$literal": 0},
+            purchases={"$literal": 1}, spent={"$ifNull": ["$total_amount", 0]}
+        ))
+        .group(
+            "customer_id",
+            name=_latest("name"),
+            phone=_latest("phone"),
+            rating=_latest("rating"),
+            total_loans=sum_of("loans"),
+            total_balance=sum_of("balance"),
+            total_purchases=sum_of("purchases"),
+            total_spent=sum_of("spent"),
+            last_purchase_at={"$max": "$purchased_at"},
+            created_at={"$min": "$created_at"}
+        )
+        .project(
+            _id=0,
+            id="$_id",
+            name={"$ifNull": [{"$arrayElemAt": ["$name", 1]}, ""]},
+            name_lower={"$toLower": {"$ifNull": [{"$arrayElemAt": ["$name", 1]}, ""]}},
+            phone={"$ifNull": [{"$arrayElemAt": ["$phone", 1]}, ""]},
+            payment_rating={"$ifNull": [{"$arrayElemAt": ["$rating", 1]}, "New Customer"]},
+            total_loans=1, total_balance=1, total_purchases=1, total_spent=1,
+            last_purchase_at=1,
+            created_at={"$ifNull": ["$created_at", {"$literal": rebuilt_at}]},
+            updated_at={"$literal": rebuilt_at},
+            rebuilt_at={"$literal": rebuilt_at}
+        )
+        # "merge" keeps fields the rebuild does not derive, such as credit_limit
+        .add({"$merge": {"into": "customers", "on": "id", "whenMatched": "merge", "whenNotMatched": "insert"}})
+        .run(db.loans)
+    )
+
+    # Prune only entries with no loans or sales at all (not just ones another,
+    # overlapping rebuild wrote), and never one a live sale or credit hold
+    # has touched since this rebuild began
+    produced = set(await db.loans.distinct("customer_id", has_customer))
+    produced |= set(await db.sales_transactions.distinct("customer_id", has_customer))
+    await db.customers.delete_many({"id": {"$nin": list(produced)}, "updated_at": {"$lt": rebuilt_at}})
+    count = await db.customers.count_documents({})
+    logger.info(f"Customer directory rebuilt ({count} customers)")
+    return count
+
+CUSTOMER_DIRECTORY_TASK = "customer_directory"
+CUSTOMER_DIRECTORY_LEASE_SECONDS = 600
+
+async def ensure_customer_directory():
+    """Build the customer directory on first start after it was introduced
+
+    Every worker calls this at startup. A leased `maintenance_tasks` document
+    makes the build single-flight, and it is marked done only once the
+    build finishes, so a crashed build is retried on a later start.
+    """
+    now = utc_now()
+    lease = now + timedelta(seconds=CUSTOMER_DIRECTORY_LEASE_SECONDS)
+    try:
+        await db.maintenance_tasks.insert_one({"_id": CUSTOMER_DIRECTORY_TASK, "state": "running", "locked_until": lease})
+    except DuplicateKeyError:
+        claimed = await db.maintenance_tasks.find_one_and_update(
+            {"_id": CUSTOMER_DIRECTORY_TASK, "state": {"$ne": "done"}, "locked_until": {"$not": {"$gt": now}}},
+            {"$set": {"state": "running", "locked_until": lease}}
+        )
+        if not claimed:
+            # Already built, or another worker is building it right now
+            return
+
+    if await db.loans.count_documents({"customer_id": {"$nin": [None, ""]}}, limit=1) or \
+            await db.sales_transactions.count_documents({"customer_id": {"$nin": [None, ""]}}, limit=1):
+        await rebuild_customers()
+    await db.maintenance_tasks.update_one(
+        {"_id": CUSTOMER_DIRECTORY_TASK},
+        {"$set": {"state": "done", "completed_at": utc_now()}, "$unset": {"locked_until": ""}}
+    )
+
+# ==================== SALES MODULE ====================
+
+# Upper bound on transactions accepted by one /sales-transactions/batch call
+MAX_SALES_BATCH_SIZE = 500
+
+def build_sales_transaction(transaction_data: Dict[str, Any], created_at: Optional[datetime] = None) -> Dict[str, Any]:
+    """Build a sales transaction document from request data"""
+    
+    # Calculate total
+    items = transaction_data.get("items", [])
+    total_amount = sum(item.get('quantity_kg', 0) * item.get('unit_price', 0) for item in items)
     
     # Determine status based on payment type
     payment_type = transaction_data.get("payment_type", "cash")
     status = "unpaid" if payment_type == "loan" else "paid"
     
-    transaction = {
+    return {
         "id": str(uuid.uuid4()),
         "transaction_number": f"TXN-{datetime.now().strftime('%Y%m%d%H%M%S')}-{str(uuid.uuid4())[:4]}",
         "items": items,
@@ -872,65 +2227,348 @@ async def create_sales_transaction(transaction_data: Dict[str, Any]):
         "branch_id": transaction_data.get("branch_id"),
         "customer_id": transaction_data.get("customer_id"),
         "customer_name": transaction_data.get("customer_name"),
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": created_at or utc_now(),
         "reconciliation_status": "pending"
     }
+
+def build_loan(transaction_data: Dict[str, Any], amount: float) -> Dict[str, Any]:
+    """Build a new active loan document for a credit sale"""
+    return {
+        "id": str(uuid.uuid4()),
+        "customer_id": transaction_data.get("customer_id"),
+        "customer_name": transaction_data.get("customer_name"),
+        "customer_phone": transaction_data.get("customer_phone", ""),
+        "initial_amount": amount,
+        "balance": amount,
+        "paid_amount": 0,
+        "branch_id": transaction_data.get("branch_id"),
+        "created_at": utc_now(),
+        "due_date": utc_now() + timedelta(days=30),
+        "status": "active",
+        "payment_history_rating": "New Customer"
+    }
+
+def loan_charge_update(transaction_data: Dict[str, Any], amount: float) -> tuple:
+    """Filter and update adding `amount` to the customer's active loan
+
+    Used as an upsert: the balance is $inc'd in place, and if the customer
+    has no active loan a new one is created from build_loan() in the same
+    atomic operation. The partial unique index on active loans per customer
+    stops concurrent first sales from opening two loans.
+    """
+    loan = build_loan(transaction_data, amount)
+    filter_ = {"customer_id": loan["customer_id"], "status": "active"}
+    update = {
+        "$inc": {"balance": amount, "initial_amount": amount},
+        "$setOnInsert": {
+            key: value for key, value in loan.items()
+            if key not in ("customer_id", "status", "balance", "initial_amount")
+        }
+    }
+    return filter_, update
+
+async def charge_customer_loan(transaction_data: Dict[str, Any], amount: float) -> tuple:
+    """Atomically add a credit sale to the customer's active loan
+
+    Returns (loan, created) where `created` is True if a new loan was opened.
+    """
+    filter_, update = loan_charge_update(transaction_data, amount)
+    new_loan_id = update["$setOnInsert"]["id"]
+    try:
+        loan = await db.loans.find_one_and_update(
+            filter_, update, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Another sale opened the loan first; add to it instead
+        loan = await db.loans.find_one_and_update(
+            filter_, update, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    return loan, loan["id"] == new_loan_id
+
+@api_router.post("/sales-transactions")
+async def create_sales_transaction(transaction_data: Dict[str, Any]):
+    """Create a new sales transaction
+
+    Stock is reserved first with a guarded decrement; if any line cannot be
+    covered the sale is rejected with 409 and nothing is written. Pass
+    "allow_backorder": true to record the sale anyway with the short lines
+    listed in "backordered_items".
+    """
+    
+    transaction = build_sales_transaction(transaction_data)
+    items = transaction["items"]
+    total_amount = transaction["total_amount"]
+    payment_type = transaction["payment_type"]
+    branch_id = transaction_data.get("branch_id")
+    is_credit = payment_type == "loan" and bool(transaction_data.get("customer_id"))
+    
+    # Authorize credit sales against the customer's limit before anything else
+    if is_credit:
+        await authorize_credit(transaction_data, total_amount)
+    
+    # Reserve stock before anything is written
+    try:
+        backordered = await reserve_inventory(branch_id, items, transaction_data.get("allow_backorder", False))
+    except Exception:
+        if is_credit:
+            await release_credit(transaction_data["customer_id"], total_amount)
+        raise
+    if backordered:
+        transaction["backordered_items"] = backordered
     
     # Make a copy without _id for response
     response_data = transaction.copy()
     
-    await db.sales_transactions.insert_one(transaction)
-    
+    try:
+        await db.sales_transactions.insert_one(transaction)
+    except Exception:
+        # Roll back the reservation so a failed sale doesn't leak stock
+        backordered_ids = {line["product_id"] for line in backordered}
+        await release_inventory({
+            key: quantity
+            for key, quantity in aggregate_inventory_lines(branch_id, items).items()
+            if key[0] not in backordered_ids
+        })
+        if is_credit:
+            await release_credit(transaction_data["customer_id"], total_amount)
+        raise
+
+    ledger_deltas = {"total_income": total_amount, "sales_count": 1}
+
     # If loan, create loan record
-    if payment_type == "loan" and transaction_data.get("customer_id"):
-        existing_loan = await db.loans.find_one({"customer_id": transaction_data.get("customer_id"), "status": "active"}, {"_id": 0})
-        
-        if existing_loan:
-            # Add to existing loan
-            new_balance = existing_loan.get("balance", 0) + total_amount
-            await db.loans.update_one(
-                {"id": existing_loan["id"]},
-                {"$set": {"balance": new_balance, "initial_amount": existing_loan.get("initial_amount", 0) + total_amount}}
-            )
-        else:
-            # Create new loan
-            loan = {
-                "id": str(uuid.uuid4()),
-                "customer_id": transaction_data.get("customer_id"),
-                "customer_name": transaction_data.get("customer_name"),
-                "customer_phone": transaction_data.get("customer_phone", ""),
-                "initial_amount": total_amount,
-                "balance": total_amount,
-                "paid_amount": 0,
-                "branch_id": transaction_data.get("branch_id"),
-                "created_at": datetime.now(timezone.utc).isoformat(),
-                "due_date": (datetime.now(timezone.utc) + timedelta(days=30)).isoformat(),
-                "status": "active",
-                "payment_history_rating": "New Customer"
-            }
-            await db.loans.insert_one(loan)
+    created = False
+    if is_credit:
+        _, created = await charge_customer_loan(transaction_data, total_amount)
+        ledger_deltas["accounts_receivable"] = total_amount
+        if created:
+            ledger_deltas["active_loan_count"] = 1
+
+    await update_finance_ledger(**ledger_deltas)
     
-    # Deduct from inventory
-    for item in items:
-        await db.inventory.update_one(
-            {"id": item.get("product_id"), "branch_id": transaction_data.get("branch_id")},
-            {"$inc": {"quantity": -item.get("quantity_kg", 0)}}
-        )
+    # The credit hold already counted the balance
+    await record_customer_activity(
+        transaction_data,
+        inc={"total_purchases": 1, "total_spent": total_amount, "total_loans": int(created)},
+        purchased_at=transaction["created_at"]
+    )
     
     await log_activity("Sales", "transaction", f"Created sales transaction {transaction['transaction_number']}", branch=transaction_data.get("branch_id"))
     
     return response_data
 
+@api_router.post("/sales-transactions/batch")
+async def create_sales_transactions_batch(batch_data: Dict[str, Any]):
+    """Create many sales transactions in one call (POS terminal sync)
+
+    Body: {"transactions": [<same payload as POST /sales-transactions>, ...]}
+
+    Entries may carry the terminal's own "id" and "created_at"; re-sending
+    an id that was already stored is reported as a duplicate, so a terminal
+    can safely replay a sync. Stock for all entries is allocated against one
+    inventory snapshot and taken with one guarded update_one per product,
+    sent concurrently (entries that cannot be covered are rejected unless
+    they set "allow_backorder"). Accepted transactions are written with one
+    insert_many and loan balance changes are aggregated per customer.
+    """
+    entries = batch_data.get("transactions")
+    
+    if not isinstance(entries, list) or not entries:
+        raise HTTPException(status_code=400, detail="transactions must be a non-empty list")
+    
+    if len(entries) > MAX_SALES_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {MAX_SALES_BATCH_SIZE} transactions")
+    
+    results: List[Dict[str, Any]] = [{"index": index, "success": False} for index in range(len(entries))]
+    accepted = []  # (index, entry, transaction)
+    
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("branch_id") or not isinstance(entry.get("items"), list):
+            results[index]["error"] = "branch_id and items are required"
+            continue
+        transaction = build_sales_transaction(entry, created_at=parse_timestamp(entry.get("created_at")))
+        if entry.get("id"):
+            transaction["id"] = str(entry["id"])
+        accepted.append((index, entry, transaction))
+    
+    # Drop entries the terminal already synced before reserving any stock
+    client_ids = [t["id"] for _, entry, t in accepted if entry.get("id")]
+    if client_ids:
+        existing = await db.sales_transactions.find({"id": {"$in": client_ids}}, {"_id": 0, "id": 1}).to_list(None)
+        existing_ids = {doc["id"] for doc in existing}
+        for index, _, transaction in accepted:
+            if transaction["id"] in existing_ids:
+                results[index]["error"] = "duplicate"
+        accepted = [a for a in accepted if a[2]["id"] not in existing_ids]
+    
+    # Authorize credit per customer (all of a customer's credit entries together)
+    credit_requests: Dict[str, Dict[str, Any]] = {}
+    for _, entry, transaction in accepted:
+        if transaction["payment_type"] == "loan" and transaction.get("customer_id"):
+            request = credit_requests.setdefault(transaction["customer_id"], {"entry": entry, "amount": 0})
+            request["amount"] += transaction["total_amount"]
+    
+    async def hold(customer_id: str, request: Dict[str, Any]) -> Optional[str]:
+        try:
+            await authorize_credit(request["entry"], request["amount"])
+        except HTTPException as e:
+            return e.detail
+        return None
+    
+    credit_errors = dict(zip(
+        credit_requests.keys(),
+        await asyncio.gather(*(hold(customer_id, request) for customer_id, request in credit_requests.items()))
+    ))
+    
+    authorized = []
+    for index, entry, transaction in accepted:
+        error = credit_errors.get(transaction.get("customer_id")) if transaction["payment_type"] == "loan" else None
+        if error:
+            results[index]["error"] = error
+            continue
+        authorized.append((index, entry, transaction))
+    accepted = authorized
+    
+    # Credit held for entries that end up not being recorded
+    unheld: Dict[str, float] = {}
+    
+    def unhold(transaction: Dict[str, Any]):
+        if transaction["payment_type"] == "loan" and transaction.get("customer_id"):
+            unheld[transaction["customer_id"]] = unheld.get(transaction["customer_id"], 0) + transaction["total_amount"]
+    
+    # Reserve stock for every entry against one inventory snapshot
+    outcomes = await reserve_inventory_batch([
+        (transaction["branch_id"], transaction["items"], bool(entry.get("allow_backorder")))
+        for _, entry, transaction in accepted
+    ]) if accepted else []
+    
+    reserved = []
+    for (index, entry, transaction), backordered in zip(accepted, outcomes):
+        if backordered is None:
+            results[index]["error"] = "insufficient stock"
+            unhold(transaction)
+            continue
+        if backordered:
+            transaction["backordered_items"] = backordered
+        reserved.append((index, entry, transaction))
+    accepted = reserved
+    
+    # Insert everything in one round trip; duplicates/invalid rows don't block the rest
+    failed_positions = {}
+    if accepted:
+        try:
+            await db.sales_transactions.insert_many([t for _, _, t in accepted], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed_positions[error["index"]] = "duplicate" if error.get("code") == 11000 else error.get("errmsg", "insert failed")
+    
+    inserted = []
+    unreserve: Dict[tuple, float] = {}
+    for position, (index, entry, transaction) in enumerate(accepted):
+        transaction.pop("_id", None)
+        if position in failed_positions:
+            results[index]["error"] = failed_positions[position]
+            # Give back the stock reserved for a row that was not written
+            backordered_ids = {line["product_id"] for line in transaction.get("backordered_items", [])}
+            for key, quantity in aggregate_inventory_lines(transaction["branch_id"], transaction["items"]).items():
+                if key[0] not in backordered_ids:
+                    unreserve[key] = unreserve.get(key, 0) + quantity
+            unhold(transaction)
+            continue
+        results[index].update({"success": True, "transaction": transaction})
+        inserted.append((entry, transaction))
+    await release_inventory(unreserve)
+    await asyncio.gather(*(release_credit(customer_id, amount) for customer_id, amount in unheld.items()))
+    
+    # Aggregate loan balance changes per customer
+    loan_charges: Dict[str, Dict[str, Any]] = {}
+    for entry, transaction in inserted:
+        if transaction["payment_type"] == "loan" and transaction.get("customer_id"):
+            charge = loan_charges.setdefault(transaction["customer_id"], {"entry": entry, "amount": 0})
+            charge["amount"] += transaction["total_amount"]
+    
+    ledger_deltas = {
+        "total_income": sum(t["total_amount"] for _, t in inserted),
+        "sales_count": len(inserted)
+    }
+    
+    opened_for = set()
+    if loan_charges:
+        charged = list(loan_charges.keys())
+        operations = [
+            UpdateOne(*loan_charge_update(loan_charges[customer_id]["entry"], loan_charges[customer_id]["amount"]), upsert=True)
+            for customer_id in charged
+        ]
+        try:
+            result = await db.loans.bulk_write(operations, ordered=False)
+            opened_for.update(charged[index] for index in result.upserted_ids)
+        except BulkWriteError as e:
+            # Upserts that raced another sale opening the same loan: apply them again
+            opened_for.update(charged[upsert["index"]] for upsert in e.details.get("upserted", []))
+            retry = [error["index"] for error in e.details.get("writeErrors", []) if error.get("code") == 11000]
+            if len(retry) < len(e.details.get("writeErrors", [])):
+                raise
+            result = await db.loans.bulk_write([operations[index] for index in retry], ordered=False)
+            opened_for.update(charged[retry[index]] for index in result.upserted_ids)
+        
+        ledger_deltas["accounts_receivable"] = sum(c["amount"] for c in loan_charges.values())
+        ledger_deltas["active_loan_count"] = len(opened_for)
+    
+    await update_finance_ledger(**ledger_deltas)
+    
+    # Running totals per customer, one upsert each
+    customer_totals: Dict[str, Dict[str, Any]] = {}
+    for entry, transaction in inserted:
+        if not transaction.get("customer_id"):
+            continue
+        totals = customer_totals.setdefault(transaction["customer_id"], {
+            "entry": entry, "purchases": 0, "spent": 0, "last": transaction["created_at"]
+        })
+        totals["entry"] = entry
+        totals["purchases"] += 1
+        totals["spent"] += transaction["total_amount"]
+        totals["last"] = max(totals["last"], transaction["created_at"])
+    await bulk_record_customer_activity([
+        customer_update(
+            totals["entry"],
+            inc={
+                "total_purchases": totals["purchases"],
+                "total_spent": totals["spent"],
+                "total_loans": int(customer_id in opened_for)
+            },
+            purchased_at=totals["last"]
+        )
+        for customer_id, totals in customer_totals.items()
+    ])
+    
+    if inserted:
+        branches = sorted({t["branch_id"] for _, t in inserted})
+        await log_activity(
+            "Sales",
+            "transaction_batch",
+            f"Synced {len(inserted)} sales transaction(s) (Br {ledger_deltas['total_income']:,.2f})",
+            branch=branches[0] if len(branches) == 1 else None
+        )
+    
+    return {
+        "success": len(inserted) == len(entries),
+        "created": len(inserted),
+        "failed": len(entries) - len(inserted),
+        "results": results
+    }
+
 @api_router.get("/sales-transactions")
-async def get_sales_transactions(branch_id: Optional[str] = None):
-    """Get sales transactions"""
+async def get_sales_transactions(
+    response: Response,
+    branch_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Get sales transactions, newest first"""
     query = {}
     if branch_id:
         query["branch_id"] = branch_id
     
-    # Exclude MongoDB's _id field to avoid serialization issues
-    transactions = await db.sales_transactions.find(query, {"_id": 0}).to_list(1000)
-    return transactions
+    return await paginate(db.sales_transactions, query, response, "created_at", cursor, limit)
 
 # ==================== LOANS MODULE ====================
 
@@ -946,49 +2584,68 @@ async def get_loans(status: Optional[str] = None, limit: int = Query(100, ge=1,
 
 @api_router.post("/loans/{loan_id}/payment")
 async def record_loan_payment(loan_id: str, payment_data: Dict[str, Any]):
-    """Record a payment for a loan"""
-    
-    # Get the loan
-    loan = await db.loans.find_one({"id": loan_id}, {"_id": 0})
-    
-    if not loan:
-        raise HTTPException(status_code=404, detail="Loan not found")
-    
-    if loan.get("status") != "active":
-        raise HTTPException(status_code=400, detail="Can only record payments for active loans")
+    """Record a payment for a loan
+
+    The balance is decremented with a guarded $inc, so concurrent payments
+    can never lose an update or take the balance below zero.
+    """
     
     payment_amount = payment_data.get("amount", 0)
-    current_balance = loan.get("balance", 0)
-    current_paid = loan.get("paid_amount", 0)
     
     if payment_amount <= 0:
         raise HTTPException(status_code=400, detail="Payment amount must be greater than 0")
     
-    if payment_amount > current_balance:
-        raise HTTPException(status_code=400, detail="Payment amount cannot exceed loan balance")
-    
-    # Calculate new balances
-    new_balance = current_balance - payment_amount
-    new_paid_amount = current_paid + payment_amount
+    current_time = utc_now()
     
-    # Determine new status
-    new_status = "paid" if new_balance <= 0 else "active"
-    
-    # Update loan
-    current_time = datetime.now(timezone.utc).isoformat()
+    loan = await db.loans.find_one_and_update(
+        {"id": loan_id, "status": "active", "balance": {"$gte": payment_amount}},
+        {
+            "$inc": {"balance": -payment_amount, "paid_amount": payment_amount},
+            "$set": {"last_payment_date": current_time}
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     
-    update_data = {
-        "balance": new_balance,
-        "paid_amount": new_paid_amount,
-        "status": new_status,
-        "last_payment_date": current_time
-    }
+    if not loan:
+        # Work out why the guarded update did not apply
+        existing = await db.loans.find_one({"id": loan_id}, {"_id": 0, "status": 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Loan not found")
+        if existing.get("status") != "active":
+            raise HTTPException(status_code=400, detail="Can only record payments for active loans")
+        raise HTTPException(status_code=400, detail="Payment amount cannot exceed loan balance")
     
-    await db.loans.update_one(
-        {"id": loan_id},
-        {"$set": update_data}
+    new_balance = loan.get("balance", 0)
+    current_balance = new_balance + payment_amount
+    
+    # Close the loan once it is paid off; the guard makes exactly one payment do this
+    loan_closed = False
+    if new_balance <= 0:
+        closed = await db.loans.find_one_and_update(
+            {"id": loan_id, "status": "active", "balance": {"$lte": 0}},
+            {"$set": {"status": "paid"}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if closed:
+            loan = closed
+            loan_closed = True
+
+    await update_finance_ledger(
+        accounts_receivable=-payment_amount,
+        active_loan_count=-1 if loan_closed else 0
     )
     
+    customer_changes = {"last_payment_at": current_time}
+    if loan_closed:
+        customer_changes["overdue"] = False
+    await record_customer_activity(
+        {"customer_id": loan.get("customer_id")},
+        inc={"total_balance": -payment_amount},
+        set_fields=customer_changes
+    )
+
     # Create payment record
     payment_record = {
         "id": str(uuid.uuid4()),
@@ -1018,7 +2675,7 @@ async def record_loan_payment(loan_id: str, payment_data: Dict[str, Any]):
         branch=loan.get("branch_id")
     )
     
-    return {"success": True, "payment": response_data, "updated_loan": {**loan, **update_data}}
+    return {"success": True, "payment": response_data, "updated_loan": loan}
 
 @api_router.get("/loans/{loan_id}/payments")
 async def get_loan_payments(loan_id: str):
@@ -1038,29 +2695,411 @@ async def get_loan_payments(loan_id: str):
     return payments
 
 @api_router.get("/customers")
-async def get_customers(limit: int = Query(100, ge=1, le=1000)):
-    """Get customers (from loans and sales transactions)"""
-    # Get unique customers from loans
-    loans = await db.loans.find({}, {"_id": 0}).to_list(1000)
-    
-    customers = {}
-    for loan in loans:
-        customer_id = loan.get("customer_id")
-        if customer_id and customer_id not in customers:
-            customers[customer_id] = {
-                "id": customer_id,
-                "name": loan.get("customer_name"),
-                "phone": loan.get("customer_phone", ""),
-                "total_loans": 0,
-                "total_balance": 0,
-                "payment_rating": loan.get("payment_history_rating", "Good")
-            }
-        
-        if customer_id in customers:
-            customers[customer_id]["total_loans"] += 1
-            customers[customer_id]["total_balance"] += loan.get("balance", 0)
+async def get_customers(
+    response: Response,
+    search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """Get customers by name, optionally searching by name or phone prefix"""
+    query = {}
+    if search:
+        query["$or"] = [
+            {"name_lower": {"$regex": f"^{re.escape(search.lower())}"}},
+            {"phone": {"$regex": f"^{re.escape(search)}"}}
+        ]
+    
+    return await paginate(db.customers, query, response, "name_lower", cursor, limit, direction=ASCENDING)
+
+@api_router.get("/customers/{customer_id}/credit")
+async def get_customer_credit(customer_id: str):
+    """Credit exposure for a customer: balance, limit, availability, overdue flag"""
+    customer = await db.customers.find_one(
+        {"id": customer_id},
+        {"_id": 0, "id": 1, "name": 1, "total_balance": 1, "credit_limit": 1, "overdue": 1}
+    )
+    
+    if not customer:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    
+    controls = await financial_controls_cache.get()
+    credit_limit = customer.get("credit_limit", controls.default_customer_credit_limit)
+    balance = customer.get("total_balance", 0)
+    
+    return {
+        "customer_id": customer_id,
+        "name": customer.get("name"),
+        "balance": balance,
+        "credit_limit": credit_limit,
+        "available_credit": max(credit_limit - balance, 0),
+        "overdue": customer.get("overdue", False)
+    }
+
+@api_router.put("/customers/{customer_id}/credit-limit")
+async def update_customer_credit_limit(customer_id: str, limit_data: Dict[str, Any]):
+    """Set a customer-specific credit limit (null reverts to the default)"""
+    credit_limit = limit_data.get("credit_limit")
+    
+    if credit_limit is None:
+        update = {"$unset": {"credit_limit": ""}}
+    elif isinstance(credit_limit, (int, float)) and not isinstance(credit_limit, bool) and credit_limit >= 0:
+        update = {"$set": {"credit_limit": credit_limit}}
+    else:
+        raise HTTPException(status_code=400, detail="credit_limit must be a non-negative number or null")
+    
+    result = await db.customers.update_one({"id": customer_id}, update)
+    
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    
+    await log_activity(
+        "Owner",
+        "credit_limit",
+        f"Set credit limit for customer {customer_id} to {'default' if credit_limit is None else f'Br {credit_limit:,.2f}'}"
+    )
+    
+    return await get_customer_credit(customer_id)
+
+# ==================== LOAN AGING ====================
+
+# A background job buckets every active loan by age (days since it was
+# opened) and rates it by days past due. Branch totals go to
+# `loan_aging_summary` and per-customer results onto the customer directory,
+# so collections views are a single read. The job is idempotent, and stale
+# summaries are removed by id, so overlapping runs on several workers never
+# wipe each other's results.
+LOAN_AGING_INTERVAL_SECONDS = float(os.environ.get('LOAN_AGING_INTERVAL_SECONDS', 3600))
+AGING_BUCKETS = [(30, "0-30"), (60, "31-60"), (90, "61-90"), (None, "90+")]
+# Rating by days past due; loans that are not overdue are rated "Good"
+OVERDUE_RATINGS = [(30, "Fair"), (60, "Poor"), (None, "Bad")]
+DAY_MS = 24 * 60 * 60 * 1000
+
+def _as_date(field_name: str) -> Dict[str, Any]:
+    """Date value of a field that may still hold a pre-migration string
+
+    Missing or unparseable values become null (not aged / not overdue)
+    instead of failing the whole aggregation.
+    """
+    return {"$convert": {"input": f"${field_name}", "to": "date", "onError": None, "onNull": None}}
+
+def _first_match(days: float, table: List[tuple]) -> str:
+    for upper, label in table:
+        if upper is None or days <= upper:
+            return label
+
+def loan_rating(loan: Dict[str, Any]) -> str:
+    if loan["days_overdue"] > 0:
+        return _first_match(loan["days_overdue"], OVERDUE_RATINGS)
+    # A current loan with nothing paid yet keeps its introductory rating
+    if loan.get("rating") == "New Customer" and not loan.get("paid_amount"):
+        return "New Customer"
+    return "Good"
+
+def empty_aging_summary(summary_id: str, scope: str, branch_id: Optional[str], computed_at: Optional[datetime]) -> Dict[str, Any]:
+    return {
+        "id": summary_id,
+        "scope": scope,
+        "branch_id": branch_id,
+        "buckets": {label: {"balance": 0, "count": 0} for _, label in AGING_BUCKETS},
+        "total_balance": 0,
+        "loan_count": 0,
+        "overdue_balance": 0,
+        "overdue_count": 0,
+        "computed_at": computed_at
+    }
+
+async def run_loan_aging() -> Dict[str, Any]:
+    """Recompute aging buckets, overdue flags and ratings for active loans"""
+    now = utc_now()
+    summaries = {"all": empty_aging_summary("all", "all", None, now)}
+    loan_operations = []
+    customer_operations = []
+
+    cursor = db.loans.aggregate(
+        Pipeline()
+        .match({"status": "active"})
+        .project(
+            _id=0, id=1, customer_id=1, branch_id=1, paid_amount=1,
+            balance={"$ifNull": ["$balance", 0]},
+            rating="$payment_history_rating",
+            days_outstanding={"$floor": {"$divide": [{"$subtract": [now, _as_date("created_at")]}, DAY_MS]}},
+            days_overdue={"$cond": [
+                {"$and": [{"$ifNull": [_as_date("due_date"), False]}, {"$gt": [now, _as_date("due_date")]}]},
+                {"$ceil": {"$divide": [{"$subtract": [now, _as_date("due_date")]}, DAY_MS]}},
+                0
+            ]}
+        )
+        .build()
+    )
+
+    async for loan in cursor:
+        bucket = _first_match(max(loan.get("days_outstanding") or 0, 0), AGING_BUCKETS)
+        overdue = loan["days_overdue"] > 0
+        rating = loan_rating(loan)
+
+        branch_id = loan.get("branch_id")
+        summary_id = f"branch:{branch_id}"
+        if summary_id not in summaries:
+            summaries[summary_id] = empty_aging_summary(summary_id, "branch", branch_id, now)
+        for summary in (summaries["all"], summaries[summary_id]):
+            summary["buckets"][bucket]["balance"] += loan["balance"]
+            summary["buckets"][bucket]["count"] += 1
+            summary["total_balance"] += loan["balance"]
+            summary["loan_count"] += 1
+            if overdue:
+                summary["overdue_balance"] += loan["balance"]
+                summary["overdue_count"] += 1
+
+        if rating != loan.get("rating"):
+            loan_operations.append(UpdateOne({"id": loan["id"]}, {"$set": {"payment_history_rating": rating}}))
+        if loan.get("customer_id"):
+            customer_operations.append(UpdateOne({"id": loan["customer_id"]}, {"$set": {
+                "payment_rating": rating,
+                "overdue": overdue,
+                "days_overdue": loan["days_overdue"],
+                "aging_bucket": bucket
+            }}))
+
+    if loan_operations:
+        await db.loans.bulk_write(loan_operations, ordered=False)
+    if customer_operations:
+        await db.customers.bulk_write(customer_operations, ordered=False)
+
+    await db.loan_aging_summary.bulk_write([
+        ReplaceOne({"id": summary_id}, summary, upsert=True)
+        for summary_id, summary in summaries.items()
+    ], ordered=False)
+    # Branches with no active loans left
+    await db.loan_aging_summary.delete_many({"id": {"$nin": list(summaries)}})
+
+    logger.info(f"Loan aging computed for {summaries['all']['loan_count']} active loans ({len(loan_operations)} re-rated)")
+    return {
+        "computed_at": now,
+        "loans": summaries["all"]["loan_count"],
+        "re_rated": len(loan_operations),
+        "overdue": summaries["all"]["overdue_count"]
+    }
+
+class LoanAgingJob:
+    """Runs run_loan_aging() every `interval` seconds in the background"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_run: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                self.last_run = await run_loan_aging()
+            except Exception:
+                logger.exception("Loan aging job failed")
+            await asyncio.sleep(self.interval)
+
+loan_aging_job = LoanAgingJob(LOAN_AGING_INTERVAL_SECONDS)
+
+@api_router.get("/loans/aging")
+async def get_loan_aging(branch_id: Optional[str] = None):
+    """Precomputed receivables aging: overall and per branch (or one branch)"""
+    query = {"id": f"branch:{branch_id}"} if branch_id else {}
+    summaries = await db.loan_aging_summary.find(query, {"_id": 0}).sort("id", 1).to_list(None)
+    
+    if branch_id and not summaries:
+        return empty_aging_summary(f"branch:{branch_id}", "branch", branch_id, None)
+    
+    return summaries[0] if branch_id else summaries
+
+@api_router.post("/loans/aging/run")
+async def run_loan_aging_now():
+    """Recompute loan aging immediately instead of waiting for the next run"""
+    result = await run_loan_aging()
+    loan_aging_job.last_run = result
+    return {"success": True, **result}
+
+# ==================== STOCK REQUEST WORKFLOW ====================
+
+# Every legal stock-request move, keyed by the action that performs it.
+# `at_field`/`by_field`/`notes_field` name where the timestamp, actor and
+# notes of the move are recorded; `bulk` marks actions with no side effects
+# outside the request itself, which can be applied with one update_many.
+STOCK_REQUEST_TRANSITIONS: Dict[str, Dict[str, Any]] = {
+    "approve-admin": {
+        "source": (StockRequestStatus.PENDING_ADMIN_APPROVAL,),
+        "target": StockRequestStatus.PENDING_MANAGER_APPROVAL,
+        "stage": "admin_approval",
+        "actor": "Admin",
+        "by_key": "approved_by",
+        "at_field": "admin_approved_at",
+        "by_field": "admin_approved_by",
+        "notes_field": "admin_notes",
+        "bulk": True,
+    },
+    "approve-manager": {
+        "source": (StockRequestStatus.PENDING_MANAGER_APPROVAL,),
+        "target": StockRequestStatus.PENDING_FULFILLMENT,
+        "stage": "manager_approval",
+        "actor": "Manager",
+        "by_key": "approved_by",
+        "at_field": "manager_approved_at",
+        "by_field": "manager_approved_by",
+        "notes_field": "manager_notes",
+        "bulk": True,
+    },
+    "fulfill": {
+        "source": (StockRequestStatus.PENDING_FULFILLMENT,),
+        "target": StockRequestStatus.READY_FOR_PICKUP,
+        "stage": "fulfillment",
+        "actor": "Storekeeper",
+        "by_key": "fulfilled_by",
+        "at_field": "fulfilled_at",
+        "by_field": "fulfilled_by",
+        "notes_field": "fulfillment_notes",
+        "bulk": False,  # moves inventory
+    },
+    "approve-gate-pass": {
+        "source": (StockRequestStatus.PENDING_GATE_APPROVAL,),
+        "target": StockRequestStatus.READY_FOR_PICKUP,
+        "stage": "gate_pass_approval",
+        "actor": "Manager",
+        "by_key": "approved_by",
+        "at_field": "gate_pass_approved_at",
+        "by_field": "gate_pass_approved_by",
+        "notes_field": None,
+        "bulk": True,
+    },
+    "gate-verify": {
+        "source": (StockRequestStatus.READY_FOR_PICKUP,),
+        "target": StockRequestStatus.IN_TRANSIT,
+        "stage": "gate_verification",
+        "actor": "Guard",
+        "by_key": "verified_by",
+        "at_field": "gate_verified_at",
+        "by_field": "verified_by",
+        "notes_field": None,
+        "bulk": True,
+    },
+    "confirm-delivery": {
+        # Sales can confirm receipt of a pickup straight from ready_for_pickup
+        "source": (StockRequestStatus.READY_FOR_PICKUP, StockRequestStatus.IN_TRANSIT),
+        "target": StockRequestStatus.CONFIRMED,
+        "stage": "delivery_confirmation",
+        "actor": "Unknown",
+        "by_key": "confirmed_by",
+        "at_field": "delivered_at",
+        "by_field": "confirmed_by",
+        "notes_field": "delivery_notes",
+        "bulk": True,
+    },
+    "cancel": {
+        "source": (
+            StockRequestStatus.PENDING_ADMIN_APPROVAL,
+            StockRequestStatus.PENDING_MANAGER_APPROVAL,
+            StockRequestStatus.PENDING_FULFILLMENT,
+        ),
+        "target": StockRequestStatus.CANCELLED,
+        "stage": "cancellation",
+        "actor": "Unknown",
+        "by_key": "cancelled_by",
+        "at_field": "cancelled_at",
+        "by_field": "cancelled_by",
+        "notes_field": "cancellation_notes",
+        "bulk": True,
+    },
+}
+
+# (current status, action) pairs compiled once so a move can be validated in O(1)
+STOCK_REQUEST_MOVES = frozenset(
+    (source.value, action)
+    for action, transition in STOCK_REQUEST_TRANSITIONS.items()
+    for source in transition["source"]
+)
+
+MAX_STOCK_REQUEST_BATCH_SIZE = 500
+
+def can_transition_stock_request(current: Optional[str], action: str) -> bool:
+    return (current, action) in STOCK_REQUEST_MOVES
+
+def stock_request_transition(
+    action: str,
+    data: Dict[str, Any],
+    current_time: datetime,
+    set_fields: Optional[Dict[str, Any]] = None,
+    history_fields: Optional[Dict[str, Any]] = None,
+    by: Optional[str] = None
+) -> tuple:
+    """Build the (guard, update) pair for a transition from the table
+
+    The guard pins the expected current status so it can be used as the
+    filter of a single atomic write (guarded_update or update_many).
+    """
+    transition = STOCK_REQUEST_TRANSITIONS[action]
+    target = transition["target"].value
+    by = by or data.get(transition["by_key"], transition["actor"])
+    notes = data.get("notes", "")
+
+    sources = [source.value for source in transition["source"]]
+    guard = {"status": sources[0] if len(sources) == 1 else {"$in": sources}}
+
+    changes = {"status": target, transition["at_field"]: current_time, transition["by_field"]: by}
+    if transition["notes_field"]:
+        changes[transition["notes_field"]] = notes
+    changes.update(set_fields or {})
+
+    entry = {
+        "stage": transition["stage"],
+        "timestamp": current_time,
+        "by": by,
+        "status": target,
+        "notes": notes,
+        **(history_fields or {})
+    }
+
+    return guard, {"$set": changes, "$push": {"workflow_history": entry}}
+
+async def transition_stock_request(action: str, request_id: str, data: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+    """Apply one table transition to one stock request and return it"""
+    guard, update = stock_request_transition(action, data, utc_now(), **kwargs)
+    return await guarded_update(db.stock_requests, request_id, guard, update, "Stock request")
+
+async def transition_stock_requests(
+    action: str,
+    query: Dict[str, Any],
+    data: Dict[str, Any],
+    set_fields: Optional[Dict[str, Any]] = None,
+    history_fields: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
+    """Apply one table transition to every request matching `query`
+
+    One update_many does the move; requests not in the source status are
+    left alone. The history entry is tagged with a transition id so the
+    requests this call actually moved can be returned.
+    """
+    transition_id = str(uuid.uuid4())
+    guard, update = stock_request_transition(
+        action, data, utc_now(),
+        set_fields=set_fields,
+        history_fields={**(history_fields or {}), "transition_id": transition_id}
+    )
+    
+    await db.stock_requests.update_many({**query, **guard}, update)
     
-    return list(customers.values())[:limit]
+    return await db.stock_requests.find(
+        {**query, "workflow_history.transition_id": transition_id},
+        {"_id": 0}
+    ).to_list(None)
 
 # ==================== STOCK REQUESTS ====================
 
@@ -1081,7 +3120,7 @@ async def create_stock_request(request_data: Dict[str, Any]):
     quantity_kg = quantity if "quantity_kg" in request_data else quantity * kg_per_package
     total_weight = quantity * kg_per_package if isinstance(quantity, (int, float)) else quantity_kg
     
-    current_time = datetime.now(timezone.utc).isoformat()
+    current_time = utc_now()
     
     stock_request = {
         "id": str(uuid.uuid4()),
@@ -1099,7 +3138,7 @@ async def create_stock_request(request_data: Dict[str, Any]):
         "requested_by": request_data.get("requested_by"),
         "requested_by_id": request_data.get("requested_by_id", str(uuid.uuid4())),
         "requested_at": current_time,
-        "status": "pending_admin_approval",  # Initial status awaiting admin
+        "status": StockRequestStatus.PENDING_ADMIN_APPROVAL.value,  # Initial status awaiting admin
         "inventory_reserved": False,
         # Batch processing
         "batch_id": request_data.get("batch_id"),
@@ -1113,7 +3152,7 @@ async def create_stock_request(request_data: Dict[str, Any]):
             "stage": "created",
             "timestamp": current_time,
             "by": request_data.get("requested_by", "Unknown"),
-            "status": "pending_admin_approval"
+            "status": StockRequestStatus.PENDING_ADMIN_APPROVAL.value
         }]
     }
     
@@ -1127,11 +3166,14 @@ async def create_stock_request(request_data: Dict[str, Any]):
 
 @api_router.get("/stock-requests")
 async def get_stock_requests(
+    response: Response,
     status: Optional[str] = None,
     source_branch: Optional[str] = None,
-    is_customer_delivery: Optional[bool] = None
+    is_customer_delivery: Optional[bool] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
 ):
-    """Get stock requests with optional filters"""
+    """Get stock requests with optional filters, newest first"""
     query = {}
     if status:
         query["status"] = status
@@ -1140,8 +3182,214 @@ async def get_stock_requests(
     if is_customer_delivery is not None:
         query["is_customer_delivery"] = is_customer_delivery
     
-    requests = await db.stock_requests.find(query, {"_id": 0}).to_list(1000)
-    return requests
+    return await paginate(db.stock_requests, query, response, "requested_at", cursor, limit)
+
+@api_router.post("/stock-requests/bulk-transition")
+async def bulk_transition_stock_requests(transition_data: Dict[str, Any]):
+    """Move many stock requests through the same stage with one update_many
+    
+    Body: {"action": "approve-admin", "request_ids": [...], "notes": ..., "approved_by": ...}
+    Requests not in the action's source status are left untouched and
+    reported under `skipped`.
+    """
+    action = transition_data.get("action")
+    request_ids = list(dict.fromkeys(transition_data.get("request_ids") or []))
+    
+    transition = STOCK_REQUEST_TRANSITIONS.get(action)
+    if not transition or not transition["bulk"]:
+        allowed = [name for name, t in STOCK_REQUEST_TRANSITIONS.items() if t["bulk"]]
+        raise HTTPException(status_code=400, detail=f"Unsupported bulk action. Use one of: {', '.join(allowed)}")
+    if not request_ids:
+        raise HTTPException(status_code=400, detail="request_ids must be a non-empty list")
+    if len(request_ids) > MAX_STOCK_REQUEST_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_STOCK_REQUEST_BATCH_SIZE} requests per call")
+    
+    moved = await transition_stock_requests(action, {"id": {"$in": request_ids}}, transition_data)
+    transitioned = {doc["id"] for doc in moved}
+    
+    await log_activity(
+        transition["actor"],
+        transition["stage"],
+        f"Bulk {action}: {len(transitioned)} of {len(request_ids)} stock request(s) moved to {transition['target'].value}"
+    )
+    
+    return {
+        "success": True,
+        "action": action,
+        "status": transition["target"].value,
+        "transitioned": [rid for rid in request_ids if rid in transitioned],
+        "skipped": [rid for rid in request_ids if rid not in transitioned]
+    }
+
+async def stock_request_batch_result(batch_id: str, action: str, moved: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Shape a batch transition response, or explain why nothing moved"""
+    if not moved:
+        if not await db.stock_requests.count_documents({"batch_id": batch_id}, limit=1):
+            raise HTTPException(status_code=404, detail="Stock request batch not found")
+        raise HTTPException(
+            status_code=409,
+            detail=f"No stock requests in batch {batch_id} can be moved by {action}"
+        )
+    
+    return {
+        "success": True,
+        "batch_id": batch_id,
+        "action": action,
+        "status": STOCK_REQUEST_TRANSITIONS[action]["target"].value,
+        "count": len(moved),
+        "requests": moved
+    }
+
+@api_router.put("/stock-requests/batch/{batch_id}/approve-admin")
+async def approve_stock_request_batch_admin(batch_id: str, approval_data: Dict[str, Any]):
+    """Admin approves every pending request in a batch at once"""
+    
+    moved = await transition_stock_requests(
+        "approve-admin", {"batch_id": batch_id}, approval_data,
+        set_fields={"inventory_reserved": True}
+    )
+    result = await stock_request_batch_result(batch_id, "approve-admin", moved)
+    
+    await log_activity("Admin", "approval", f"Approved {len(moved)} stock request(s) in batch {batch_id}")
+    
+    return result
+
+@api_router.put("/stock-requests/batch/{batch_id}/approve-manager")
+async def approve_stock_request_batch_manager(batch_id: str, approval_data: Dict[str, Any]):
+    """Manager approves every admin-approved request in a batch at once"""
+    
+    moved = await transition_stock_requests("approve-manager", {"batch_id": batch_id}, approval_data)
+    result = await stock_request_batch_result(batch_id, "approve-manager", moved)
+    
+    await log_activity("Manager", "approval", f"Approved {len(moved)} stock request(s) in batch {batch_id}")
+    
+    return result
+
+def transfer_line(doc: Dict[str, Any]) -> Optional[tuple]:
+    """(product_name, source_branch) a stock request takes stock from, if any"""
+    if doc.get("product_name") and doc.get("source_branch") and doc.get("quantity_kg", 0) > 0:
+        return doc["product_name"], doc["source_branch"]
+    return None
+
+async def take_transfer_stock(docs: List[Dict[str, Any]]) -> tuple:
+    """Take source-branch stock for stock requests with guarded decrements
+    
+    Each request gets its own {"quantity": {"$gte": qty}} decrement, so a
+    transfer can never drive inventory negative. Returns (taken, short):
+    the requests whose stock was taken, keyed by id, and the ids of those
+    whose product is stocked but cannot be covered. Requests with no
+    inventory row to draw from appear in neither.
+    """
+    lines = {transfer_line(doc) for doc in docs} - {None}
+    stocked = set()
+    if lines:
+        rows = await db.inventory.find(
+            {"$or": [{"name": name, "branch_id": branch} for name, branch in lines]},
+            {"_id": 0, "name": 1, "branch_id": 1}
+        ).to_list(None)
+        stocked = {(row["name"], row["branch_id"]) for row in rows}
+    
+    deductible = [doc for doc in docs if transfer_line(doc) in stocked]
+    results = await asyncio.gather(*(
+        db.inventory.update_one(
+            {"name": doc["product_name"], "branch_id": doc["source_branch"], "quantity": {"$gte": doc["quantity_kg"]}},
+            {"$inc": {"quantity": -doc["quantity_kg"]}}
+        )
+        for doc in deductible
+    ))
+    taken = {doc["id"]: doc for doc, result in zip(deductible, results) if result.matched_count}
+    short = [doc["id"] for doc in deductible if doc["id"] not in taken]
+    return taken, short
+
+async def return_transfer_stock(docs: List[Dict[str, Any]]):
+    """Give back stock taken by take_transfer_stock()"""
+    returned: Dict[tuple, float] = {}
+    for doc in docs:
+        line = transfer_line(doc)
+        returned[line] = returned.get(line, 0) + doc["quantity_kg"]
+    if returned:
+        await db.inventory.bulk_write([
+            UpdateOne({"name": name, "branch_id": branch}, {"$inc": {"quantity": quantity}})
+            for (name, branch), quantity in returned.items()
+        ], ordered=False)
+
+@api_router.put("/stock-requests/batch/{batch_id}/fulfill")
+async def fulfill_stock_request_batch(batch_id: str, fulfillment_data: Dict[str, Any]):
+    """Storekeeper fulfills every approved request in a batch at once
+    
+    Stock is taken first with one guarded decrement per request, so a
+    transfer can never drive inventory negative; requests whose stock cannot
+    be covered stay pending and are listed in `insufficient_stock`. The rest
+    are then claimed (guarded update_many), and stock taken for any request
+    fulfilled concurrently in between is given back.
+    """
+    
+    candidates = await db.stock_requests.find(
+        {"batch_id": batch_id, "status": StockRequestStatus.PENDING_FULFILLMENT.value},
+        {"_id": 0, "id": 1, "source_branch": 1, "product_name": 1, "quantity_kg": 1}
+    ).to_list(None)
+    
+    taken, insufficient = await take_transfer_stock(candidates)
+    stocked_ids = set(taken) | set(insufficient)
+    
+    fulfillment = {
+        "fulfilled_by": fulfillment_data.get("fulfilled_by", "Storekeeper"),
+        "notes": fulfillment_data.get("notes", "")
+    }
+    
+    moved = []
+    for inventory_deducted, ids in (
+        (True, list(taken)),
+        (False, [doc["id"] for doc in candidates if doc["id"] not in stocked_ids]),
+    ):
+        if ids:
+            moved += await transition_stock_requests(
+                "fulfill", {"batch_id": batch_id, "id": {"$in": ids}}, fulfillment_data,
+                set_fields={"inventory_deducted": inventory_deducted, "fulfillment": fulfillment},
+                history_fields={"inventory_deducted": inventory_deducted}
+            )
+    
+    # Give back stock taken for requests another fulfillment claimed first
+    claimed = {doc["id"] for doc in moved}
+    await return_transfer_stock([doc for request_id, doc in taken.items() if request_id not in claimed])
+    
+    if not moved and insufficient:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Insufficient stock to fulfill stock request(s): {', '.join(insufficient)}"
+        )
+    result = await stock_request_batch_result(batch_id, "fulfill", moved)
+    result["insufficient_stock"] = insufficient
+    
+    await log_activity("StoreKeeper", "fulfillment", f"Fulfilled {len(moved)} stock request(s) in batch {batch_id}")
+    
+    return result
+
+@api_router.put("/stock-requests/batch/{batch_id}/gate-verify")
+async def gate_verify_stock_request_batch(batch_id: str, verification_data: Dict[str, Any]):
+    """Guard verifies and releases a whole batch for delivery under one gate pass"""
+    
+    moved = await transition_stock_requests(
+        "gate-verify", {"batch_id": batch_id}, verification_data,
+        set_fields={
+            "gate_pass_number": verification_data.get("gate_pass_number"),
+            "vehicle_number": verification_data.get("vehicle_number"),
+            "driver_name": verification_data.get("driver_name"),
+            "gate_verification": {
+                "verified_by": verification_data.get("verified_by", "Guard"),
+                "gate_pass_number": verification_data.get("gate_pass_number"),
+                "vehicle_number": verification_data.get("vehicle_number"),
+                "driver_name": verification_data.get("driver_name"),
+                "notes": verification_data.get("notes", "")
+            }
+        },
+        history_fields={"gate_pass": verification_data.get("gate_pass_number")}
+    )
+    result = await stock_request_batch_result(batch_id, "gate-verify", moved)
+    
+    await log_activity("Guard", "gate_verification", f"Verified {len(moved)} stock request(s) in batch {batch_id} for delivery")
+    
+    return result
 
 @api_router.get("/stock-requests/{request_id}")
 async def get_stock_request_by_id(request_id: str):
@@ -1157,34 +3405,12 @@ async def get_stock_request_by_id(request_id: str):
 async def approve_stock_request_admin(request_id: str, approval_data: Dict[str, Any]):
     """Admin approves a stock request"""
     
-    current_time = datetime.now(timezone.utc).isoformat()
-    
-    result = await db.stock_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "pending_manager_approval",  # After admin approval, awaits manager
-            "admin_approved_at": current_time,
-            "admin_approved_by": approval_data.get("approved_by", "Admin"),
-            "admin_notes": approval_data.get("notes", ""),
-            "inventory_reserved": True  # Admin reserves inventory
-        },
-        "$push": {
-            "workflow_history": {
-                "stage": "admin_approval",
-                "timestamp": current_time,
-                "by": approval_data.get("approved_by", "Admin"),
-                "status": "pending_manager_approval",
-                "notes": approval_data.get("notes", "")
-            }
-        }}
+    # After admin approval, awaits manager; admin reserves inventory
+    updated = await transition_stock_request(
+        "approve-admin", request_id, approval_data,
+        set_fields={"inventory_reserved": True}
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Stock request not found")
-    
-    # Get updated request
-    updated = await db.stock_requests.find_one({"id": request_id}, {"_id": 0})
-    
     await log_activity("Admin", "approval", f"Approved stock request {request_id}")
     
     return updated
@@ -1193,32 +3419,8 @@ async def approve_stock_request_admin(request_id: str, approval_data: Dict[str,
 async def approve_stock_request_manager(request_id: str, approval_data: Dict[str, Any]):
     """Manager approves a stock request"""
     
-    current_time = datetime.now(timezone.utc).isoformat()
-    
-    result = await db.stock_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "pending_fulfillment",  # After manager approval, awaits storekeeper fulfillment
-            "manager_approved_at": current_time,
-            "manager_approved_by": approval_data.get("approved_by", "Manager"),
-            "manager_notes": approval_data.get("notes", "")
-        },
-        "$push": {
-            "workflow_history": {
-                "stage": "manager_approval",
-                "timestamp": current_time,
-                "by": approval_data.get("approved_by", "Manager"),
-                "status": "pending_fulfillment",
-                "notes": approval_data.get("notes", "")
-            }
-        }}
-    )
-    
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Stock request not found")
-    
-    # Get updated request
-    updated = await db.stock_requests.find_one({"id": request_id}, {"_id": 0})
+    # After manager approval, awaits storekeeper fulfillment
+    updated = await transition_stock_request("approve-manager", request_id, approval_data)
     
     await log_activity("Manager", "approval", f"Approved stock request {request_id}")
     
@@ -1234,50 +3436,40 @@ async def fulfill_stock_request(request_id: str, fulfillment_data: Dict[str, Any
     if not stock_request:
         raise HTTPException(status_code=404, detail="Stock request not found")
     
-    # Deduct inventory from source branch
-    source_branch = stock_request.get("source_branch")
-    product_name = stock_request.get("product_name")
-    quantity_kg = stock_request.get("quantity_kg", 0)
+    if not can_transition_stock_request(stock_request.get("status"), "fulfill"):
+        raise HTTPException(
+            status_code=409,
+            detail=f"Stock request cannot be updated from its current status: {stock_request.get('status')}"
+        )
     
-    if source_branch and product_name and quantity_kg > 0:
-        # Try to deduct from inventory
-        deduct_result = await db.inventory.update_one(
-            {"name": product_name, "branch_id": source_branch},
-            {"$inc": {"quantity": -quantity_kg}}
+    # Deduct inventory from source branch (same guarded decrement as batches)
+    taken, short = await take_transfer_stock([stock_request])
+    if short:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Insufficient {stock_request.get('product_name')} stock at {stock_request.get('source_branch')} to fulfill this request"
         )
-        inventory_deducted = deduct_result.modified_count > 0
-    else:
-        inventory_deducted = False
+    inventory_deducted = bool(taken)
     
     # Update stock request
-    current_time = datetime.now(timezone.utc).isoformat()
-    
-    result = await db.stock_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "ready_for_pickup",  # Changed from pending_gate_approval
-            "fulfilled_at": current_time,
-            "fulfilled_by": fulfillment_data.get("fulfilled_by", "Storekeeper"),
-            "fulfillment_notes": fulfillment_data.get("notes", ""),
-            "inventory_deducted": inventory_deducted,
-            "fulfillment": {
-                "fulfilled_by": fulfillment_data.get("fulfilled_by", "Storekeeper"),
-                "notes": fulfillment_data.get("notes", "")
-            }
-        },
-        "$push": {
-            "workflow_history": {
-                "stage": "fulfillment",
-                "timestamp": current_time,
-                "by": fulfillment_data.get("fulfilled_by", "Storekeeper"),
-                "status": "ready_for_pickup",
-                "inventory_deducted": inventory_deducted
-            }
-        }}
-    )
+    fulfilled_by = fulfillment_data.get("fulfilled_by", "Storekeeper")
     
-    # Get updated request
-    updated = await db.stock_requests.find_one({"id": request_id}, {"_id": 0})
+    try:
+        updated = await transition_stock_request(
+            "fulfill", request_id, fulfillment_data,
+            set_fields={
+                "inventory_deducted": inventory_deducted,
+                "fulfillment": {
+                    "fulfilled_by": fulfilled_by,
+                    "notes": fulfillment_data.get("notes", "")
+                }
+            },
+            history_fields={"inventory_deducted": inventory_deducted}
+        )
+    except HTTPException:
+        # Another fulfillment won the race; give the stock back
+        await return_transfer_stock(list(taken.values()))
+        raise
     
     await log_activity("StoreKeeper", "fulfillment", f"Fulfilled stock request {request_id}")
     
@@ -1287,14 +3479,9 @@ async def fulfill_stock_request(request_id: str, fulfillment_data: Dict[str, Any
 async def gate_verify_stock_request(request_id: str, verification_data: Dict[str, Any]):
     """Guard verifies and releases stock for delivery"""
     
-    current_time = datetime.now(timezone.utc).isoformat()
-    
-    result = await db.stock_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "in_transit",
-            "gate_verified_at": current_time,
-            "verified_by": verification_data.get("verified_by", "Guard"),
+    updated = await transition_stock_request(
+        "gate-verify", request_id, verification_data,
+        set_fields={
             "gate_pass_number": verification_data.get("gate_pass_number"),
             "vehicle_number": verification_data.get("vehicle_number"),
             "driver_name": verification_data.get("driver_name"),
@@ -1306,23 +3493,9 @@ async def gate_verify_stock_request(request_id: str, verification_data: Dict[str
                 "notes": verification_data.get("notes", "")
             }
         },
-        "$push": {
-            "workflow_history": {
-                "stage": "gate_verification",
-                "timestamp": current_time,
-                "by": verification_data.get("verified_by", "Guard"),
-                "status": "in_transit",
-                "gate_pass": verification_data.get("gate_pass_number")
-            }
-        }}
+        history_fields={"gate_pass": verification_data.get("gate_pass_number")}
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Stock request not found")
-    
-    # Get updated request
-    updated = await db.stock_requests.find_one({"id": request_id}, {"_id": 0})
-    
     await log_activity("Guard", "gate_verification", f"Verified stock request {request_id} for delivery")
     
     return updated
@@ -1331,36 +3504,24 @@ async def gate_verify_stock_request(request_id: str, verification_data: Dict[str
 async def approve_gate_pass(request_id: str, approval_data: Dict[str, Any]):
     """Approve gate pass for stock request"""
     
-    result = await db.stock_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "ready_for_pickup",
-            "gate_pass_approved_at": datetime.now(timezone.utc).isoformat(),
-            "gate_pass_approved": True
-        }}
+    await transition_stock_request(
+        "approve-gate-pass", request_id, approval_data,
+        set_fields={"gate_pass_approved": True}
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Stock request not found")
-    
     return {"success": True}
 
 @api_router.put("/stock-requests/{request_id}/confirm-delivery")
 async def confirm_delivery(request_id: str, delivery_data: Dict[str, Any]):
     """Confirm delivery of stock request"""
     
-    current_time = datetime.now(timezone.utc).isoformat()
-    
-    result = await db.stock_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "confirmed",  # Final status
-            "delivered_at": current_time,
+    updated = await transition_stock_request(
+        "confirm-delivery", request_id, delivery_data,
+        by=delivery_data.get("confirmed_by", delivery_data.get("received_by", "Unknown")),
+        set_fields={
             "delivery_confirmed": True,
-            "confirmed_by": delivery_data.get("confirmed_by", delivery_data.get("received_by", "Unknown")),
             "received_quantity": delivery_data.get("received_quantity"),
             "condition": delivery_data.get("condition", "good"),
-            "delivery_notes": delivery_data.get("notes", ""),
             "delivery_confirmation": {
                 "confirmed_by": delivery_data.get("confirmed_by", "Unknown"),
                 "received_quantity": delivery_data.get("received_quantity"),
@@ -1368,24 +3529,12 @@ async def confirm_delivery(request_id: str, delivery_data: Dict[str, Any]):
                 "notes": delivery_data.get("notes", "")
             }
         },
-        "$push": {
-            "workflow_history": {
-                "stage": "delivery_confirmation",
-                "timestamp": current_time,
-                "by": delivery_data.get("confirmed_by", "Unknown"),
-                "status": "confirmed",
-                "received_quantity": delivery_data.get("received_quantity"),
-                "condition": delivery_data.get("condition", "good")
-            }
-        }}
+        history_fields={
+            "received_quantity": delivery_data.get("received_quantity"),
+            "condition": delivery_data.get("condition", "good")
+        }
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Stock request not found")
-    
-    # Get updated request
-    updated = await db.stock_requests.find_one({"id": request_id}, {"_id": 0})
-    
     await log_activity("Sales", "delivery_confirmation", f"Confirmed delivery of stock request {request_id}")
     
     return updated
@@ -1394,19 +3543,10 @@ async def confirm_delivery(request_id: str, delivery_data: Dict[str, Any]):
 async def dispatch_customer_delivery(request_id: str, dispatch_data: Dict[str, Any]):
     """Mark customer delivery as dispatched (Manager action)"""
     
-    current_time = datetime.now(timezone.utc).isoformat()
-    
-    # Get the stock request first to verify it's a customer delivery
-    stock_request = await db.stock_requests.find_one({"id": request_id}, {"_id": 0})
-    
-    if not stock_request:
-        raise HTTPException(status_code=404, detail="Stock request not found")
-    
-    if not stock_request.get("is_customer_delivery"):
-        raise HTTPException(status_code=400, detail="This request is not a customer delivery")
+    current_time = utc_now()
     
-    result = await db.stock_requests.update_one(
-        {"id": request_id},
+    updated = await db.stock_requests.find_one_and_update(
+        {"id": request_id, "is_customer_delivery": True, "dispatch_status": "pending_dispatch"},
         {"$set": {
             "dispatch_status": "dispatched",
             "dispatch_info": {
@@ -1426,14 +3566,25 @@ async def dispatch_customer_delivery(request_id: str, dispatch_data: Dict[str, A
                 "status": "dispatched",
                 "notes": dispatch_data.get("dispatch_notes", "")
             }
-        }}
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Failed to update dispatch status")
-    
-    # Get updated request
-    updated = await db.stock_requests.find_one({"id": request_id}, {"_id": 0})
+    if not updated:
+        # Only read back to explain why the guarded update did not apply
+        stock_request = await db.stock_requests.find_one(
+            {"id": request_id},
+            {"_id": 0, "is_customer_delivery": 1, "dispatch_status": 1}
+        )
+        if not stock_request:
+            raise HTTPException(status_code=404, detail="Stock request not found")
+        if not stock_request.get("is_customer_delivery"):
+            raise HTTPException(status_code=400, detail="This request is not a customer delivery")
+        raise HTTPException(
+            status_code=409,
+            detail=f"Customer delivery already {stock_request.get('dispatch_status')}"
+        )
     
     await log_activity("Manager", "customer_dispatch", f"Dispatched customer delivery {request_id}")
     
@@ -1441,11 +3592,14 @@ async def dispatch_customer_delivery(request_id: str, dispatch_data: Dict[str, A
 
 @api_router.get("/customer-deliveries")
 async def get_customer_deliveries(
+    response: Response,
     status: Optional[str] = None,
     dispatch_status: Optional[str] = None,
-    branch_id: Optional[str] = None
+    branch_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
 ):
-    """Get all customer delivery requests with optional filters"""
+    """Get customer delivery requests with optional filters, newest first"""
     query = {"is_customer_delivery": True}
     
     if status:
@@ -1455,29 +3609,21 @@ async def get_customer_deliveries(
     if branch_id:
         query["source_branch"] = branch_id
     
-    deliveries = await db.stock_requests.find(query, {"_id": 0}).sort("requested_at", -1).to_list(1000)
-    return deliveries
+    return await paginate(db.stock_requests, query, response, "requested_at", cursor, limit)
 
 # ==================== PURCHASE REQUESTS ====================
 
-@api_router.post("/purchase-requests")
-async def create_purchase_request(request_data: Dict[str, Any]):
-    """Create a new purchase request
-    
-    Workflow:
-    1. Sales creates request with status 'pending_approval'
-    2. If amount <= admin_threshold: Admin approves → Finance pays
-    3. If amount > admin_threshold: Owner approves → Finance pays
-    
-    Manager is NOT in the approval chain for purchase requests!
-    """
-    
+MAX_PURCHASE_BATCH_SIZE = 500
+
+async def get_admin_purchase_threshold() -> float:
+    """Amount up to which Admin (rather than Owner) approves a purchase"""
+    controls = await financial_controls_cache.get()
+    return controls.admin_purchase_approval_threshold
+
+def build_purchase_request(request_data: Dict[str, Any], admin_threshold: float) -> Dict[str, Any]:
+    """Build a purchase requisition document, routed by amount"""
     estimated_cost = request_data.get("estimated_cost", 0)
     
-    # Get financial controls to determine initial routing
-    controls = await db.financial_controls.find_one({})
-    admin_threshold = controls.get("admin_purchase_approval_threshold", 50000) if controls else 50000
-    
     # Determine initial status and routing based on amount
     if estimated_cost <= admin_threshold:
         initial_status = "pending_admin_approval"
@@ -1486,7 +3632,7 @@ async def create_purchase_request(request_data: Dict[str, Any]):
         initial_status = "pending_owner_approval"
         routing = "owner"
     
-    purchase_request = {
+    return {
         "id": str(uuid.uuid4()),
         "request_number": f"PR-{datetime.now().strftime('%Y%m%d%H%M%S')}-{str(uuid.uuid4())[:4]}",
         "description": request_data.get("description"),
@@ -1496,7 +3642,7 @@ async def create_purchase_request(request_data: Dict[str, Any]):
         "estimated_cost": estimated_cost,
         "supplier_name": request_data.get("supplier_name", request_data.get("vendor_name")),
         "requested_by": request_data.get("requested_by"),
-        "requested_at": datetime.now(timezone.utc).isoformat(),
+        "requested_at": utc_now(),
         "status": initial_status,
         "routing": routing,  # 'admin' or 'owner'
         "branch_id": request_data.get("branch_id"),
@@ -1506,8 +3652,28 @@ async def create_purchase_request(request_data: Dict[str, Any]):
         "category": request_data.get("category", "general"),
         "vendor_contact": request_data.get("vendor_contact", ""),
         "payment_source": request_data.get("payment_source", "finance"),  # 'sales_revenue' or 'finance'
-        "admin_threshold": admin_threshold
+        "admin_threshold": admin_threshold,
+        "batch_number": request_data.get("batch_number")
     }
+
+@api_router.post("/purchase-requests")
+async def create_purchase_request(request_data: Dict[str, Any]):
+    """Create a new purchase request
+    
+    Workflow:
+    1. Sales creates request with status 'pending_approval'
+    2. If amount <= admin_threshold: Admin approves → Finance pays
+    3. If amount > admin_threshold: Owner approves → Finance pays
+    
+    Manager is NOT in the approval chain for purchase requests!
+    """
+    
+    # Get financial controls to determine initial routing
+    admin_threshold = await get_admin_purchase_threshold()
+    
+    purchase_request = build_purchase_request(request_data, admin_threshold)
+    estimated_cost = purchase_request["estimated_cost"]
+    routing = purchase_request["routing"]
     
     # Make a copy for response
     response_data = purchase_request.copy()
@@ -1522,6 +3688,59 @@ async def create_purchase_request(request_data: Dict[str, Any]):
     
     return response_data
 
+@api_router.post("/purchase-requests/bulk")
+async def create_purchase_requests_bulk(batch_data: Dict[str, Any]):
+    """Create many purchase requests (a quick-add list) in one call
+    
+    Body: {"items": [{...}, ...], "requested_by": ..., "branch_id": ..., "batch_number": ...}
+    Top-level fields are defaults for every item. Financial controls are read
+    once, each line is routed by amount in memory and the batch is inserted
+    with a single insert_many.
+    """
+    items = batch_data.get("items")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="items must be a non-empty list")
+    if len(items) > MAX_PURCHASE_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PURCHASE_BATCH_SIZE} items per batch")
+    
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"Item {index} must be an object")
+        cost = item.get("estimated_cost", 0)
+        if isinstance(cost, bool) or not isinstance(cost, (int, float)) or cost < 0:
+            raise HTTPException(status_code=400, detail=f"Item {index} has an invalid estimated_cost")
+    
+    defaults = {k: v for k, v in batch_data.items() if k != "items"}
+    defaults.setdefault("batch_number", f"PRB-{datetime.now().strftime('%Y%m%d%H%M%S')}-{str(uuid.uuid4())[:4]}")
+    
+    admin_threshold = await get_admin_purchase_threshold()
+    purchase_requests = [build_purchase_request({**defaults, **item}, admin_threshold) for item in items]
+    
+    # Make copies for response
+    response_data = [purchase_request.copy() for purchase_request in purchase_requests]
+    
+    await db.purchase_requisitions.insert_many(purchase_requests)
+    
+    routed_to_owner = sum(1 for purchase_request in purchase_requests if purchase_request["routing"] == "owner")
+    total_cost = sum(purchase_request["estimated_cost"] for purchase_request in purchase_requests)
+    
+    await log_activity(
+        "Sales",
+        "purchase_request",
+        f"Created {len(purchase_requests)} purchase request(s) in batch {defaults['batch_number']} "
+        f"(Br {total_cost:,.2f}) - {len(purchase_requests) - routed_to_owner} to ADMIN, {routed_to_owner} to OWNER",
+        branch=defaults.get("branch_id")
+    )
+    
+    return {
+        "success": True,
+        "batch_number": defaults["batch_number"],
+        "count": len(response_data),
+        "total_estimated_cost": total_cost,
+        "routed": {"admin": len(response_data) - routed_to_owner, "owner": routed_to_owner},
+        "requests": response_data
+    }
+
 @api_router.get("/purchase-requisitions")
 async def get_purchase_requisitions(
     status: Optional[str] = None,
@@ -1551,6 +3770,10 @@ async def get_purchase_requisition_by_id(requisition_id: str):
 
 # Manager approval removed - managers only handle factory operations, not purchase approvals
 
+# Statuses from which each approver may move a requisition to payable
+ADMIN_APPROVABLE_REQUISITION_STATUSES = ["pending_admin_approval", "pending", "manager_approved"]
+OWNER_APPROVABLE_REQUISITION_STATUSES = ADMIN_APPROVABLE_REQUISITION_STATUSES + ["pending_owner_approval"]
+
 @api_router.put("/purchase-requisitions/{requisition_id}/approve-admin")
 async def approve_purchase_request_admin(requisition_id: str, approval_data: Dict[str, Any]):
     """Admin approves a purchase requisition (up to their threshold)
@@ -1559,37 +3782,51 @@ async def approve_purchase_request_admin(requisition_id: str, approval_data: Dic
     If amount exceeds admin threshold, it should have been routed to Owner instead.
     """
     
-    requisition = await db.purchase_requisitions.find_one({"id": requisition_id}, {"_id": 0})
-    
-    if not requisition:
-        raise HTTPException(status_code=404, detail="Purchase requisition not found")
-    
-    # Check if this should have gone to owner instead
-    estimated_cost = requisition.get("estimated_cost", 0)
-    admin_threshold = requisition.get("admin_threshold", 50000)
-    
-    if estimated_cost > admin_threshold:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Amount (Br {estimated_cost:,.2f}) exceeds admin threshold (Br {admin_threshold:,.2f}). Requires Owner approval."
-        )
-    
-    result = await db.purchase_requisitions.update_one(
-        {"id": requisition_id},
+    # Status and threshold are both checked inside the write; an amount that
+    # should have gone to the owner never matches
+    updated = await db.purchase_requisitions.find_one_and_update(
+        {
+            "id": requisition_id,
+            "status": {"$in": ADMIN_APPROVABLE_REQUISITION_STATUSES},
+            "$expr": {"$lte": [
+                {"$ifNull": ["$estimated_cost", 0]},
+                {"$ifNull": ["$admin_threshold", 50000]}
+            ]}
+        },
         {"$set": {
             "status": "admin_approved",
-            "admin_approved_at": datetime.now(timezone.utc).isoformat(),
+            "admin_approved_at": utc_now(),
             "admin_approved_by": approval_data.get("approved_by", "Admin"),
             "admin_notes": approval_data.get("notes", ""),
             "next_step": "finance_payment"
-        }}
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Purchase requisition not found")
+    if not updated:
+        requisition = await db.purchase_requisitions.find_one({"id": requisition_id}, {"_id": 0})
+        
+        if not requisition:
+            raise HTTPException(status_code=404, detail="Purchase requisition not found")
+        
+        # Check if this should have gone to owner instead
+        estimated_cost = requisition.get("estimated_cost", 0)
+        admin_threshold = requisition.get("admin_threshold", 50000)
+        
+        if estimated_cost > admin_threshold:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Amount (Br {estimated_cost:,.2f}) exceeds admin threshold (Br {admin_threshold:,.2f}). Requires Owner approval."
+            )
+        raise HTTPException(
+            status_code=409,
+            detail=f"Purchase requisition cannot be approved from its current status: {requisition.get('status')}"
+        )
     
-    # Get updated requisition
-    updated = await db.purchase_requisitions.find_one({"id": requisition_id}, {"_id": 0})
+    # The guard guarantees this is the first time it becomes payable
+    estimated_cost = updated.get("estimated_cost", 0)
+    await update_finance_ledger(pending_payables=estimated_cost, pending_payables_count=1)
     
     await log_activity(
         "Admin", 
@@ -1607,29 +3844,23 @@ async def approve_purchase_request_owner(requisition_id: str, approval_data: Dic
     After owner approval, request goes to Finance for payment processing.
     """
     
-    requisition = await db.purchase_requisitions.find_one({"id": requisition_id}, {"_id": 0})
-    
-    if not requisition:
-        raise HTTPException(status_code=404, detail="Purchase requisition not found")
-    
-    estimated_cost = requisition.get("estimated_cost", 0)
-    
-    result = await db.purchase_requisitions.update_one(
-        {"id": requisition_id},
+    updated = await guarded_update(
+        db.purchase_requisitions,
+        requisition_id,
+        {"status": {"$in": OWNER_APPROVABLE_REQUISITION_STATUSES}},
         {"$set": {
             "status": "owner_approved",
-            "owner_approved_at": datetime.now(timezone.utc).isoformat(),
+            "owner_approved_at": utc_now(),
             "owner_approved_by": approval_data.get("approved_by", "Owner"),
             "owner_notes": approval_data.get("notes", ""),
             "next_step": "finance_payment"
-        }}
+        }},
+        "Purchase requisition"
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Purchase requisition not found")
-    
-    # Get updated requisition
-    updated = await db.purchase_requisitions.find_one({"id": requisition_id}, {"_id": 0})
+    # The guard guarantees this is the first time it becomes payable
+    estimated_cost = updated.get("estimated_cost", 0)
+    await update_finance_ledger(pending_payables=estimated_cost, pending_payables_count=1)
     
     await log_activity(
         "Owner", 
@@ -1644,21 +3875,38 @@ async def approve_purchase_request_owner(requisition_id: str, approval_data: Dic
 async def reject_purchase_requisition(requisition_id: str, rejection_data: Dict[str, Any]):
     """Reject a purchase requisition"""
     
-    result = await db.purchase_requisitions.update_one(
-        {"id": requisition_id},
-        {"$set": {
-            "status": "rejected",
-            "rejected_at": datetime.now(timezone.utc).isoformat(),
-            "rejected_by": rejection_data.get("rejected_by", "Unknown"),
-            "rejection_reason": rejection_data.get("reason", "No reason provided")
-        }}
+    changes = {
+        "status": "rejected",
+        "rejected_at": utc_now(),
+        "rejected_by": rejection_data.get("rejected_by", "Unknown"),
+        "rejection_reason": rejection_data.get("reason", "No reason provided")
+    }
+    
+    previous = await db.purchase_requisitions.find_one_and_update(
+        {"id": requisition_id, "status": {"$nin": ["rejected", "completed"]}},
+        {"$set": changes},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Purchase requisition not found")
+    if not previous:
+        current = await db.purchase_requisitions.find_one({"id": requisition_id}, {"_id": 0, "status": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Purchase requisition not found")
+        raise HTTPException(
+            status_code=409,
+            detail=f"Purchase requisition is already {current.get('status')}"
+        )
+
+    # Rejecting an approved requisition takes it out of pending payables
+    if previous.get("status") in ["admin_approved", "owner_approved"]:
+        await update_finance_ledger(
+            pending_payables=-previous.get("estimated_cost", 0),
+            pending_payables_count=-1
+        )
     
-    # Get updated requisition
-    updated = await db.purchase_requisitions.find_one({"id": requisition_id}, {"_id": 0})
+    # The pre-image plus the applied changes is the updated requisition
+    updated = {**previous, **changes}
     
     await log_activity("System", "rejection", f"Rejected purchase requisition {requisition_id}")
     
@@ -1680,18 +3928,19 @@ async def get_manager_queue(branch_id: Optional[str] = None):
 async def approve_manager_request(order_id: str, approval_data: Dict[str, Any]):
     """Manager approves an inventory request"""
     
-    result = await db.purchase_requisitions.update_one(
-        {"id": order_id},
+    # Only a pending request can be manager-approved; one already approved
+    # further up is counted in pending payables and must not move back
+    await guarded_update(
+        db.purchase_requisitions, order_id,
+        {"status": "pending"},
         {"$set": {
             "status": "manager_approved",
-            "manager_approved_at": datetime.now(timezone.utc).isoformat(),
+            "manager_approved_at": utc_now(),
             "approved_by_manager": approval_data.get("approved_by")
-        }}
+        }},
+        "Request"
     )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Request not found")
-    
     return {"success": True}
 
 @api_router.post("/wheat-deliveries")
@@ -1709,7 +3958,7 @@ async def create_wheat_delivery(delivery_data: Dict[str, Any]):
         "delivery_date": delivery_data.get("delivery_date"),
         "received_by": delivery_data.get("received_by"),
         "notes": delivery_data.get("notes", ""),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     # Make a copy for response
@@ -1754,7 +4003,7 @@ async def create_milling_order(order_data: Dict[str, Any]):
         "conversion_rate": 0.85,
         "mill_operator": order_data.get("mill_operator", "Unknown"),
         "created_by": order_data.get("created_by", "Manager"),
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": utc_now(),
         "status": "completed" if auto_complete else "pending",
         "notes": order_data.get("notes", "")
     }
@@ -1810,7 +4059,7 @@ async def create_milling_order(order_data: Dict[str, Any]):
                 "current_unit_cost": 35,
                 "unit_selling_price": 45,
                 "reorder_level": 1000,
-                "last_updated": datetime.now(timezone.utc).isoformat()
+                "last_updated": utc_now()
             }
             await db.inventory.insert_one(new_flour)
     
@@ -1825,18 +4074,20 @@ async def create_milling_order(order_data: Dict[str, Any]):
 
 @api_router.get("/milling-orders")
 async def get_milling_orders(
+    response: Response,
     branch_id: Optional[str] = None,
-    status: Optional[str] = None
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
 ):
-    """Get milling orders with optional filters"""
+    """Get milling orders with optional filters, newest first"""
     query = {}
     if branch_id:
         query["branch_id"] = branch_id
     if status:
         query["status"] = status
     
-    orders = await db.milling_orders.find(query, {"_id": 0}).to_list(1000)
-    return orders
+    return await paginate(db.milling_orders, query, response, "created_at", cursor, limit)
 
 @api_router.post("/milling-orders/{order_id}/complete")
 async def complete_milling_order(order_id: str, completion_data: Dict[str, Any]):
@@ -1857,23 +4108,28 @@ async def complete_milling_order(order_id: str, completion_data: Dict[str, Any])
         total_flour_output += qty
     
     # Update order status
-    current_time = datetime.now(timezone.utc).isoformat()
+    current_time = utc_now()
     
-    await db.milling_orders.update_one(
+    updated_order = await db.milling_orders.find_one_and_update(
         {"id": order_id},
         {"$set": {
             "status": "completed",
             "completed_at": current_time,
             "outputs": outputs,
             "flour_output_kg": total_flour_output
-        }}
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
     
     # Add flour products to inventory
     branch_id = order.get("branch_id")
     
+    # Support both formats: product_id/quantity OR product_name/quantity_kg.
+    # Quantities are summed per product so each inventory row is touched once.
+    by_id: Dict[str, float] = {}
+    by_name: Dict[str, Dict[str, Any]] = {}
     for output in outputs:
-        # Support both formats: product_name/quantity_kg OR product_id/quantity
         product_id = output.get("product_id")
         product_name = output.get("product_name")
         quantity = output.get("quantity_kg") or output.get("quantity", 0)
@@ -1881,46 +4137,52 @@ async def complete_milling_order(order_id: str, completion_data: Dict[str, Any])
         if quantity <= 0:
             continue
         
-        # Update by product_id if provided
         if product_id:
-            result = await db.inventory.update_one(
-                {"id": product_id, "branch_id": branch_id},
-                {"$inc": {"quantity": quantity}}
-            )
-            
-            if result.modified_count == 0:
-                # Product not found by ID, skip
-                continue
-        # Otherwise update by name
+            by_id[product_id] = by_id.get(product_id, 0) + quantity
         elif product_name:
-            existing_product = await db.inventory.find_one(
-                {"name": product_name, "branch_id": branch_id},
-                {"_id": 0}
-            )
-            
-            if existing_product:
-                # Update existing
-                await db.inventory.update_one(
-                    {"id": existing_product["id"]},
-                    {"$inc": {"quantity": quantity}}
-                )
-            else:
-                # Create new product
-                new_product = {
-                    "id": str(uuid.uuid4()),
-                    "name": product_name,
-                    "category": "Finished Product",
-                    "quantity": quantity,
-                    "unit": "kg",
-                    "branch_id": branch_id,
-                    "unit_cost": output.get("unit_cost", 35),
-                    "actual_unit_cost": 32,
-                    "current_unit_cost": output.get("unit_cost", 35),
-                    "unit_selling_price": output.get("unit_selling_price", 45),
-                    "reorder_level": 1000,
-                    "last_updated": current_time
-                }
-                await db.inventory.insert_one(new_product)
+            entry = by_name.setdefault(product_name, {"output": output, "quantity": 0})
+            entry["quantity"] += quantity
+    
+    # Look up every named product in one query
+    names = list(by_name.keys())
+    existing_by_name = {
+        product["name"]: product
+        for product in await db.inventory.find(
+            {"branch_id": branch_id, "name": {"$in": names}}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+    } if names else {}
+    
+    operations = [
+        # Unknown product ids simply match nothing
+        UpdateOne({"id": product_id, "branch_id": branch_id}, {"$inc": {"quantity": quantity}})
+        for product_id, quantity in by_id.items()
+    ]
+    for product_name in names:
+        existing_product = existing_by_name.get(product_name)
+        output = by_name[product_name]["output"]
+        quantity = by_name[product_name]["quantity"]
+        if existing_product:
+            # Update existing
+            operations.append(UpdateOne({"id": existing_product["id"]}, {"$inc": {"quantity": quantity}}))
+        else:
+            # Create new product
+            operations.append(InsertOne({
+                "id": str(uuid.uuid4()),
+                "name": product_name,
+                "category": "Finished Product",
+                "quantity": quantity,
+                "unit": "kg",
+                "branch_id": branch_id,
+                "unit_cost": output.get("unit_cost", 35),
+                "actual_unit_cost": 32,
+                "current_unit_cost": output.get("unit_cost", 35),
+                "unit_selling_price": output.get("unit_selling_price", 45),
+                "reorder_level": 1000,
+                "last_updated": current_time
+            }))
+    
+    if operations:
+        await db.inventory.bulk_write(operations, ordered=False)
     
     await log_activity(
         "Manager",
@@ -1929,9 +4191,6 @@ async def complete_milling_order(order_id: str, completion_data: Dict[str, Any])
         branch=branch_id
     )
     
-    # Get updated order
-    updated_order = await db.milling_orders.find_one({"id": order_id}, {"_id": 0})
-    
     return updated_order
 
 # ==================== SETTINGS ====================
@@ -1939,41 +4198,351 @@ async def complete_milling_order(order_id: str, completion_data: Dict[str, Any])
 @api_router.get("/settings/financial-controls")
 async def get_financial_controls():
     """Get financial control settings"""
-    controls = await db.financial_controls.find_one({}, {"_id": 0})
-    
-    if not controls:
-        controls = FinancialControls().model_dump()
-        await db.financial_controls.insert_one(controls)
+    controls = await financial_controls_cache.get()
     
-    return controls
+    return controls.model_dump()
 
 @api_router.put("/settings/financial-controls")
 async def update_financial_controls(controls_data: Dict[str, Any]):
     """Update financial control settings"""
     
-    controls_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    controls = await financial_controls_cache.update(controls_data)
     
-    result = await db.financial_controls.update_one(
-        {},
-        {"$set": controls_data},
-        upsert=True
+    return {"success": True, "controls": controls.model_dump()}
+
+# ==================== EXPORT ====================
+
+# Exportable collections: the Mongo collection, the date field used for
+# range filters and ordering, the branch field (if any) and the CSV columns.
+EXPORT_SPECS: Dict[str, Dict[str, Any]] = {
+    "sales-transactions": {
+        "collection": "sales_transactions",
+        "date_field": "created_at",
+        "branch_field": "branch_id",
+        "columns": [
+            "id", "transaction_number", "created_at", "branch_id", "payment_type", "status",
+            "total_amount", "customer_id", "customer_name", "sales_person_name", "items",
+            "reconciliation_status"
+        ],
+    },
+    "loans": {
+        "collection": "loans",
+        "date_field": "created_at",
+        "branch_field": "branch_id",
+        "columns": [
+            "id", "customer_id", "customer_name", "customer_phone", "branch_id", "initial_amount",
+            "paid_amount", "balance", "status", "payment_history_rating", "created_at", "due_date",
+            "last_payment_date"
+        ],
+    },
+    "loan-payments": {
+        "collection": "loan_payments",
+        "date_field": "payment_date",
+        "branch_field": "branch_id",
+        "columns": [
+            "id", "loan_id", "customer_id", "customer_name", "amount", "payment_method",
+            "received_by", "payment_date", "previous_balance", "new_balance", "branch_id"
+        ],
+    },
+    "payments": {
+        "collection": "payments",
+        "date_field": "processed_at",
+        "branch_field": None,
+        "columns": [
+            "id", "requisition_id", "amount", "payment_method", "bank_name", "reference_number",
+            "processed_by", "processed_at", "status"
+        ],
+    },
+}
+
+EXPORT_BATCH_SIZE = 500
+
+def csv_value(value: Any) -> Any:
+    """Flatten a document value into a CSV cell"""
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(jsonable_encoder(value))
+    return value
+
+async def stream_export(spec: Dict[str, Any], query: Dict[str, Any], export_format: str):
+    """Yield export rows in chunks; at most one batch is held in memory"""
+    date_field = spec["date_field"]
+    cursor = db[spec["collection"]].find(query, {"_id": 0}).sort(
+        [(date_field, ASCENDING), ("id", ASCENDING)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == "csv":
+        writer.writerow(spec["columns"])
+
+    rows = 0
+    async for doc in cursor:
+        if export_format == "csv":
+            writer.writerow([csv_value(doc.get(column)) for column in spec["columns"]])
+        else:
+            buffer.write(json.dumps(jsonable_encoder(doc)) + "\n")
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    yield buffer.getvalue()
+
+@api_router.get("/export/{collection}")
+async def export_collection(
+    collection: str,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    branch_id: Optional[str] = None
+):
+    """Stream a full export of sales, loans, loan payments or payments
+    
+    Rows come straight from a Mongo cursor, oldest first, so exports of any
+    size run in bounded memory. `start`/`end` are ISO-8601 timestamps
+    (`end` exclusive) applied to the collection's date field.
+    """
+    spec = EXPORT_SPECS.get(collection)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"Unknown export. Use one of: {', '.join(EXPORT_SPECS)}")
+    
+    query: Dict[str, Any] = {}
+    date_range = {}
+    for op, raw in (("$gte", start), ("$lt", end)):
+        if raw:
+            parsed = parse_timestamp(raw)
+            if not parsed:
+                raise HTTPException(status_code=400, detail=f"Invalid timestamp: {raw}")
+            date_range[op] = parsed
+    if date_range:
+        query[spec["date_field"]] = date_range
+    if branch_id:
+        if not spec["branch_field"]:
+            raise HTTPException(status_code=400, detail=f"{collection} cannot be filtered by branch")
+        query[spec["branch_field"]] = branch_id
+    
+    filename = f"{collection}-{utc_now().strftime('%Y%m%d%H%M%S')}.{format}"
+    
+    return StreamingResponse(
+        stream_export(spec, query, format),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# ==================== IMPORT ====================
+
+def sale_import_effects(doc: Dict[str, Any]) -> tuple:
+    """(ledger deltas, customer increments, purchased_at) of one imported sale"""
+    amount = doc.get("total_amount", 0)
+    return (
+        {"total_income": amount, "sales_count": 1},
+        {"total_purchases": 1, "total_spent": amount},
+        doc.get("created_at")
+    )
+
+def loan_import_effects(doc: Dict[str, Any]) -> tuple:
+    """(ledger deltas, customer increments, purchased_at) of one imported loan"""
+    balance = doc.get("balance", 0)
+    ledger = {"accounts_receivable": balance, "active_loan_count": 1} if doc.get("status") == "active" else {}
+    return ledger, {"total_loans": 1, "total_balance": balance}, None
+
+# Importable collections, the model each row is validated against and, for
+# rows that feed the finance ledger and customer directory, their effects
+IMPORT_SPECS: Dict[str, Dict[str, Any]] = {
+    "sales-transactions": {"collection": "sales_transactions", "model": SalesTransaction, "effects": sale_import_effects},
+    "loans": {"collection": "loans", "model": Loan, "effects": loan_import_effects},
+    "inventory": {"collection": "inventory", "model": InventoryItem, "effects": None},
+    "stock-requests": {"collection": "stock_requests", "model": StockRequest, "effects": None},
+}
+
+IMPORT_CHUNK_SIZE = 500
+MAX_IMPORT_ERRORS = 100
+
+async def iter_lines(chunks):
+    """Split an async stream of byte chunks into lines"""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+def merge_validated(raw: Any, validated: Any) -> Any:
+    """Overlay model-coerced values on the raw row, keeping fields the model drops"""
+    if isinstance(raw, dict) and isinstance(validated, dict):
+        return {**raw, **{key: merge_validated(raw.get(key), value) for key, value in validated.items()}}
+    if isinstance(raw, list) and isinstance(validated, list) and len(raw) == len(validated):
+        return [merge_validated(r, v) for r, v in zip(raw, validated)]
+    return validated
+
+def import_document(model, row: Dict[str, Any], collection_name: str) -> Dict[str, Any]:
+    """Validate a row and build the document to store
+
+    Typed fields are coerced by the model; everything else in the row (e.g.
+    workflow_history, backordered_items) is kept so exports round-trip, with
+    registered timestamp fields converted to native dates.
+    """
+    doc = merge_validated(row, model(**row).model_dump())
+    for path, value in _convert_timestamp_fields(doc, TIMESTAMP_FIELDS.get(collection_name, [])).items():
+        if "." in path:
+            parent, child = path.split(".", 1)
+            doc[parent] = {**doc[parent], child: value}
+        else:
+            doc[path] = value
+    return doc
+
+def import_row_error(exc: Exception) -> str:
+    """Short, single-line reason a row was rejected"""
+    if isinstance(exc, ValidationError):
+        err = exc.errors()[0]
+        location = ".".join(str(part) for part in err.get("loc", ())) or "row"
+        return f"{location}: {err.get('msg')}"
+    return str(exc)
+
+async def apply_import_effects(effects, docs: List[Dict[str, Any]]):
+    """Fold inserted rows into the ledger and customer directory as $inc deltas
+
+    Deltas commute with the live write paths, so an import can run while
+    sales and payments are being recorded.
+    """
+    ledger_deltas: Dict[str, float] = {}
+    customer_updates = []
+    for doc in docs:
+        deltas, inc, purchased_at = effects(doc)
+        for key, value in deltas.items():
+            ledger_deltas[key] = ledger_deltas.get(key, 0) + value
+        if doc.get("customer_id"):
+            customer_updates.append(customer_update(doc, inc=inc, purchased_at=purchased_at))
+    await update_finance_ledger(**ledger_deltas)
+    await bulk_record_customer_activity(customer_updates)
+
+async def import_ndjson(name: str, lines) -> Dict[str, Any]:
+    """Validate NDJSON rows and insert them in unordered chunks
+    
+    Invalid rows and rows that collide with a unique index (an existing id,
+    a second active loan for a customer) are skipped and reported by line
+    number, so an import can be re-run after fixing the file. The rows that
+    land in each chunk are applied to the ledger and customer directory.
+    """
+    spec = IMPORT_SPECS[name]
+    collection = db[spec["collection"]]
+    model = spec["model"]
+    result = {"collection": name, "inserted": 0, "failed": 0, "errors": []}
+
+    def reject(line_number: int, reason: str):
+        result["failed"] += 1
+        if len(result["errors"]) < MAX_IMPORT_ERRORS:
+            result["errors"].append({"line": line_number, "error": reason})
+
+    async def flush(chunk: List[Any]):
+        failed = set()
+        try:
+            inserted = await collection.insert_many([doc for _, doc in chunk], ordered=False)
+            result["inserted"] += len(inserted.inserted_ids)
+        except BulkWriteError as e:
+            result["inserted"] += e.details.get("nInserted", 0)
+            for write_error in e.details.get("writeErrors", []):
+                failed.add(write_error["index"])
+                line_number = chunk[write_error["index"]][0]
+                if write_error.get("code") == 11000:
+                    key = write_error.get("keyValue")
+                    reject(line_number, f"duplicate key {json.dumps(key, default=str)}" if key else "duplicate key")
+                else:
+                    reject(line_number, write_error.get("errmsg", "write failed"))
+        if spec["effects"]:
+            await apply_import_effects(
+                spec["effects"], [doc for index, (_, doc) in enumerate(chunk) if index not in failed]
+            )
+
+    chunk: List[Any] = []
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("expected a JSON object")
+            doc = import_document(model, row, spec["collection"])
+        except (ValueError, ValidationError) as e:
+            reject(line_number, import_row_error(e))
+            continue
+        chunk.append((line_number, doc))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await flush(chunk)
+            chunk = []
+    if chunk:
+        await flush(chunk)
+
+    return result
+
+@api_router.post("/import/{collection}")
+async def import_collection(collection: str, request: Request):
+    """Bulk-load historical rows from an NDJSON request body
+    
+    The body is streamed, validated against the collection's model and
+    written in chunks of IMPORT_CHUNK_SIZE. Imported sales and loans are
+    added to the finance ledger and customer directory as deltas; a full
+    recompute is the offline `manage.py rebuild-ledger` / `rebuild-customers`.
+    """
+    if collection not in IMPORT_SPECS:
+        raise HTTPException(status_code=404, detail=f"Unknown import. Use one of: {', '.join(IMPORT_SPECS)}")
+    
+    result = await import_ndjson(collection, iter_lines(request.stream()))
+    
+    await log_activity(
+        "Admin", "import",
+        f"Imported {result['inserted']} {collection} row(s), {result['failed']} rejected"
     )
     
-    return {"success": True, "controls": controls_data}
+    return result
 
 # ==================== INCLUDE ROUTER ====================
 
 app.include_router(api_router)
 
+# Idempotency sits inside CORS so replayed and rejected responses still get CORS headers
+app.add_middleware(BaseHTTPMiddleware, dispatch=idempotency_middleware)
+
+# CORS middleware (added last so it is the outermost layer)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed"],
+)
+
 # ==================== STARTUP EVENT ====================
 
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting KushuKushu ERP API...")
+    await ensure_activity_log_storage()
+    await ensure_indexes()
+    logger.info("Indexes verified")
     await initialize_sample_data()
     logger.info("Sample data initialized")
+    await get_finance_ledger()
+    await ensure_customer_directory()
+    await financial_controls_cache.get()
+    financial_controls_cache.start()
+    loan_aging_job.start()
+    activity_log_buffer.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Shutting down KushuKushu ERP API...")
+    await loan_aging_job.stop()
+    await financial_controls_cache.stop()
+    await activity_log_buffer.stop()
     client.close()
@@ -0,0 +1,132 @@
+"""
+Credit authorization against a real MongoDB server
+
+Query features such as $expr inside an upsert are only enforced by mongod,
+so these tests skip unless a server is reachable at TEST_MONGO_URL
+(default mongodb://localhost:27017). Each test uses a throwaway database.
+"""
+import asyncio
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+MONGO_URL = os.environ.get("TEST_MONGO_URL", "mongodb://localhost:27017")
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """Run a coroutine against a fresh database wired into the server module"""
+    try:
+        MongoClient(MONGO_URL, serverSelectionTimeoutMS=1000).admin.command("ping")
+    except PyMongoError:
+        pytest.skip(f"no MongoDB server at {MONGO_URL}")
+
+    db_name = f"kushukushu_test_{uuid.uuid4().hex[:8]}"
+
+    def run_coroutine(scenario):
+        async def main():
+            client = AsyncIOMotorClient(MONGO_URL, tz_aware=True)
+            monkeypatch.setattr(server, "db", client[db_name])
+            monkeypatch.setattr(
+                server, "financial_controls_cache",
+                server.FinancialControlsCache(server.FINANCIAL_CONTROLS_POLL_SECONDS)
+            )
+            try:
+                await server.db.customers.create_indexes(server.INDEX_REGISTRY["customers"])
+                return await scenario()
+            finally:
+                await client.drop_database(db_name)
+                client.close()
+
+        return asyncio.run(main())
+
+    return run_coroutine
+
+
+CUSTOMER = {"customer_id": "CUST-1", "customer_name": "Abebe Kebede", "customer_phone": "0911000000"}
+
+
+async def balance(customer_id):
+    customer = await server.db.customers.find_one({"id": customer_id}, {"_id": 0})
+    return customer and customer["total_balance"]
+
+
+def test_first_credit_sale_creates_entry_and_holds(run):
+    async def scenario():
+        await server.authorize_credit(CUSTOMER, 25000)
+        customer = await server.db.customers.find_one({"id": "CUST-1"}, {"_id": 0})
+        assert customer["total_balance"] == 25000
+        assert customer["name"] == "Abebe Kebede"
+        assert customer["total_loans"] == 0
+
+    run(scenario)
+
+
+def test_hold_over_limit_is_rejected_without_changing_balance(run):
+    async def scenario():
+        await server.authorize_credit(CUSTOMER, 90000)
+        with pytest.raises(HTTPException) as exc:
+            await server.authorize_credit(CUSTOMER, 20000)
+        assert exc.value.status_code == 400
+        assert await balance("CUST-1") == 90000
+
+    run(scenario)
+
+
+def test_new_customer_over_default_limit_is_rejected(run):
+    async def scenario():
+        with pytest.raises(HTTPException) as exc:
+            await server.authorize_credit({"customer_id": "CUST-2"}, 150000)
+        assert exc.value.status_code == 400
+        assert await server.db.customers.count_documents({"id": "CUST-2"}) == 0
+
+    run(scenario)
+
+
+def test_raised_credit_limit_allows_larger_hold(run):
+    async def scenario():
+        await server.authorize_credit(CUSTOMER, 1000)
+        await server.db.customers.update_one({"id": "CUST-1"}, {"$set": {"credit_limit": 500000}})
+        await server.authorize_credit(CUSTOMER, 300000)
+        assert await balance("CUST-1") == 301000
+
+    run(scenario)
+
+
+def test_overdue_customer_is_rejected(run):
+    async def scenario():
+        await server.authorize_credit(CUSTOMER, 1000)
+        await server.db.customers.update_one({"id": "CUST-1"}, {"$set": {"overdue": True}})
+        with pytest.raises(HTTPException) as exc:
+            await server.authorize_credit(CUSTOMER, 1)
+        assert "overdue" in exc.value.detail
+        assert await balance("CUST-1") == 1000
+
+    run(scenario)
+
+
+def test_concurrent_holds_never_exceed_limit(run):
+    async def scenario():
+        results = await asyncio.gather(
+            *(server.authorize_credit(CUSTOMER, 30000) for _ in range(5)),
+            return_exceptions=True
+        )
+        held = [result for result in results if result is None]
+        assert len(held) == 3
+        assert await balance("CUST-1") == 90000
+
+        await server.release_credit("CUST-1", 30000)
+        assert await balance("CUST-1") == 60000
+
+    run(scenario)